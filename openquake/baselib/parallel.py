@@ -178,43 +178,70 @@ a great deal of work trying to split slow sources in more manageable
 fast sources.
 
 """
+import io
 import os
 import re
-import ast
 import sys
 import stat
 import time
 import socket
 import signal
+import zlib
 import pickle
+import atexit
+import copyreg
 import inspect
 import logging
 import operator
+import threading
 import traceback
 import subprocess
 import collections
 from unittest import mock
-import multiprocessing.dummy
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from multiprocessing.connection import wait
-import psutil
 import numpy
 
 from openquake.baselib import config, hdf5
-from openquake.baselib.python3compat import decode
-from openquake.baselib.zeromq import zmq, Socket
 from openquake.baselib.performance import (
-    Monitor, memory_rss, init_performance)
+    Monitor, memory_rss, init_performance, perf_dt, task_info_dt,
+    task_sent_dt)
 from openquake.baselib.general import (
     split_in_blocks, block_splitter, AccumDict, humansize, CallableDict,
-    gettemp, engine_version, shortlist, compress, decompress, mp as mp_context)
+    gettemp, engine_version, shortlist, mp as mp_context)
 
 sys.setrecursionlimit(2000)  # raised to make pickle happier
 # see https://github.com/gem/oq-engine/issues/5230
 submit = CallableDict()
 MB = 1024 ** 2
 GB = 1024 ** 3
+SHM_MIN_SIZE = 64 * 1024  # arrays sent back via shared memory
+_PROTOCOL = pickle.HIGHEST_PROTOCOL  # looked up once
 host_cores = config.zworkers.host_cores.split(',')
 
+
+def get_host_ncores(host_cores):
+    """
+    :param host_cores: a list of strings "<host> <cores>"
+    :returns: an array with the number of cores of each host; if the
+              number is not known (i.e. -1) the mean of the others is used
+    """
+    ncores = []
+    for hc in host_cores:
+        try:
+            ncores.append(float(hc.split()[1]))
+        except (IndexError, ValueError):
+            ncores.append(-1)
+    ncores = numpy.array(ncores, float)
+    known = ncores > 0
+    ncores[~known] = ncores[known].mean() if known.any() else 1.
+    return ncores
+
+
+host_ncores = get_host_ncores(host_cores)
+
 # see https://scicomp.aalto.fi/triton/tut/array
 SLURM_BATCH = '''\
 #!/bin/bash
@@ -255,25 +282,60 @@ def no_submit(self, func, args, monitor):
     safely_call(func, args, self.task_no, monitor)
 
 
+def _check_done(fut, pool, task_no, mon):
+    # called when a task of the processpool ends: the errors raised by the
+    # task are sent back by safely_call, here the errors of the pool itself
+    # are managed, for instance a worker killed by the OOM killer
+    if fut.cancelled() or fut.exception() is None:
+        return
+    exc = fut.exception()
+    if Starmap.__dict__.get('pool') is not pool:  # already shut down
+        return
+    logging.error('Task #%d failed: %r', task_no, exc)
+    if isinstance(exc, BrokenProcessPool):
+        # a broken pool cannot run other tasks, the next Starmap.init
+        # will build a new one
+        del Starmap.pool
+    # send the error back to the master, which would wait forever otherwise
+    if isinstance(mon, Pickled):
+        mon = mon.unpickle()
+    mon.task_no = task_no
+    tb_str = ''.join(traceback.format_tb(exc.__traceback__))
+    res = Result(exc, mon, tb_str or 'Task #%d died\n' % task_no)
+    _get_zsocket(mon.backurl).send(res)
+
+
 @submit.add('processpool')
 def processpool_submit(self, func, args, monitor):
-    self.pool.apply_async(safely_call, (func, args, self.task_no, monitor))
+    fut = self.pool.submit(safely_call, func, args, self.task_no, monitor)
+    pool, task_no = self.pool, self.task_no
+    fut.add_done_callback(lambda f: _check_done(f, pool, task_no, monitor))
 
 
 @submit.add('threadpool')
 def threadpool_submit(self, func, args, monitor):
-    self.pool.apply_async(safely_call, (func, args, self.task_no, monitor))
+    self.pool.submit(safely_call, func, args, self.task_no, monitor)
+
+
+def _zmq_send(dest, cmd):
+    from openquake.baselib.zeromq import zmq, Socket
+    with Socket(dest, zmq.REQ, 'connect', timeout=300) as sock:
+        sub = sock.send(cmd)
+        assert sub == 'submitted', sub
 
 
 @submit.add('zmq')
 def zmq_submit(self, func, args, monitor):
-    idx = self.task_no % len(host_cores)
+    idx = self.next_host()
+    self.task_host[self.task_no] = idx
     host = host_cores[idx].split()[0]
     port = int(config.zworkers.ctrl_port)
     dest = 'tcp://%s:%d' % (host, port)
-    with Socket(dest, zmq.REQ, 'connect', timeout=300) as sock:
-        sub = sock.send((func, args, self.task_no, monitor))
-        assert sub == 'submitted', sub
+    # the task is sent by a background thread, so that the arguments of
+    # the next task are pickled while waiting for the workerpool reply
+    self.wait_sent()
+    self.sending = self.sender.submit(
+        _zmq_send, dest, (func, args, self.task_no, monitor))
 
 
 @submit.add('ipp')
@@ -288,7 +350,7 @@ def slurm_submit(self, func, args, monitor):
         os.mkdir(calc_dir)
     inpname = str(self.task_no + 1) + '.inp'
     with open(os.path.join(calc_dir, inpname), 'wb') as f:
-        pickle.dump((func, args, monitor), f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump((func, args, monitor), f, _PROTOCOL)
     logging.debug('saved %s', os.path.join(calc_dir, inpname))
 
 
@@ -302,8 +364,20 @@ def oq_distribute(task=None):
     return dist
 
 
-def init_workers():
-    """Used to initialize the process pool"""
+def init_workers(pids=None):
+    """
+    Used to initialize the process pool
+
+    :param pids: if given, a queue where to put the pid of the worker
+    """
+    _zsockets.clear()  # the sockets inherited by forking cannot be used
+    # the workers must not be interrupted by CTRL-C, which is managed
+    # by the master; this is done here since the workers can be restarted
+    # at any time (i.e. with max_tasks_per_child)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if pids is not None:
+        pids.put(os.getpid())
     try:
         from setproctitle import setproctitle
     except ImportError:
@@ -312,6 +386,96 @@ def init_workers():
         setproctitle('oq-worker')
 
 
+def _create_shm(size):
+    # SharedMemory only truncates the file, so a full /dev/shm would not
+    # raise an OSError but kill the process with a SIGBUS when writing
+    # into the segment; here the space is allocated upfront instead
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    try:
+        os.posix_fallocate(shm._fd, 0, size)
+    except OSError:  # for instance ENOSPC
+        shm.close()
+        shm.unlink()
+        raise
+    return shm
+
+
+def _attach(name, shape, dtype):
+    # read an array from a shared memory segment and release the segment
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name)
+    try:
+        arr = numpy.ndarray(shape, dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return arr
+
+
+class SharedArray(object):
+    """
+    A numpy array stored in a shared memory segment. When unpickled it
+    is converted back into a regular array and the segment is released,
+    so it must be unpickled exactly once.
+
+    :param arr: a numpy array with no Python objects inside
+    """
+    def __init__(self, arr):
+        shm = _create_shm(arr.nbytes)
+        numpy.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[:] = arr
+        shm.close()
+        # the segment is unlinked by the receiver; segments never received
+        # are unlinked by the resource tracker, which is shared by the
+        # master and the spawned workers, when the master exits
+        self.name = shm.name
+        self.shape = arr.shape
+        self.dtype = arr.dtype
+
+    def __reduce__(self):
+        return _attach, (self.name, self.shape, self.dtype)
+
+
+def _shm_dump(obj):
+    # replace the large arrays in obj (or in the values of the dict obj)
+    # with SharedArrays, so that they are not copied by pickle
+    def shared(arr):
+        # subclasses like recarrays are pickled as usual
+        if (type(arr) is numpy.ndarray and not arr.dtype.hasobject
+                and arr.nbytes > SHM_MIN_SIZE):
+            try:
+                return SharedArray(arr)
+            except OSError:  # for instance /dev/shm is full
+                return arr
+        return arr
+    if isinstance(obj, dict):
+        return {k: shared(v) for k, v in obj.items()}
+    return shared(obj)
+
+
+def _raw(buf):
+    # a flat memoryview on a PickleBuffer or on a bytes-like object
+    if isinstance(buf, pickle.PickleBuffer):
+        return buf.raw()
+    return memoryview(buf).cast('B')
+
+
+def _compress(pik, buffers):
+    # compress the pickle and its buffers, without pickling them again
+    return (zlib.compress(pik, 1),
+            [zlib.compress(_raw(buf), 1) for buf in buffers])
+
+
+def _uncompress(pik, buffers, compressed):
+    # returns a pickle and buffers ready for pickle.loads; the buffers
+    # are bytearrays, to get writeable arrays
+    if compressed:
+        return (zlib.decompress(pik),
+                [bytearray(zlib.decompress(buf)) for buf in buffers])
+    return pik, [buf if isinstance(buf, bytearray) else bytearray(buf)
+                 for buf in buffers]
+
+
 class Pickled(object):
     """
     An utility to manually pickling/unpickling objects. Pickled instances
@@ -319,19 +483,55 @@ class Pickled(object):
     of the pickled bytestring.
 
     :param obj: the object to pickle
+    :param shared: if True, large arrays are passed via shared memory
+    :param compress: if False, never compress (i.e. for local transfers)
+    :param copy: if True, copy the out-of-band buffers
     """
     compressed = False
+    buffers = ()
+    copy = False
 
-    def __init__(self, obj):
+    def __init__(self, obj, shared=False, compress=True, copy=False):
         self.clsname = obj.__class__.__name__
         self.calc_id = str(getattr(obj, 'calc_id', ''))  # for monitors
+        if shared:
+            obj = _shm_dump(obj)
+        # the large buffers (i.e. arrays) are kept out-of-band, so that
+        # they are not copied into the pickle but sent as separate frames;
+        # without copy=True they point to the original arrays, so the
+        # Pickled object must be sent before the arrays are changed
+        if copy:
+            self.copy = True
+        self.buffers = []
         try:
-            self.pik = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+            self.pik = self._dumps(obj, self._out_of_band)
         except TypeError as exc:  # can't pickle, show the obj in the message
             raise TypeError('%s: %s' % (exc, obj))
-        self.compressed = len(self.pik) > MB and config.distribution.compress
-        if self.compressed:
-            self.pik = compress(self.pik)
+        if compress and len(self) > MB and config.distribution.compress:
+            self.pik, self.buffers = _compress(self.pik, self.buffers)
+            self.compressed = True
+
+    def _dumps(self, obj, buffer_callback=None):
+        return pickle.dumps(obj, _PROTOCOL,
+                            buffer_callback=buffer_callback)
+
+    def _loads(self, pik, buffers):
+        return pickle.loads(pik, buffers=buffers)
+
+    def _out_of_band(self, buf):
+        # returning False means out-of-band, True in-band
+        if buf.raw().nbytes > SHM_MIN_SIZE:
+            self.buffers.append(bytes(buf.raw()) if self.copy else buf)
+            return False
+        return True
+
+    def __reduce_ex__(self, protocol):
+        state = vars(self).copy()
+        state.pop('copy', None)  # only needed when pickling
+        if protocol < 5 and self.buffers:
+            # PickleBuffers can be pickled only with protocol 5
+            state['buffers'] = [bytes(buf) for buf in self.buffers]
+        return copyreg.__newobj__, (self.__class__,), state
 
     def __repr__(self):
         """String representation of the pickled object"""
@@ -339,13 +539,96 @@ class Pickled(object):
             self.clsname, self.calc_id, humansize(len(self)))
 
     def __len__(self):
-        """Length of the pickled bytestring"""
-        return len(self.pik)
+        """Length of the pickled bytestring, including the buffers"""
+        return len(self.pik) + sum(
+            memoryview(buf).nbytes for buf in self.buffers)
 
     def unpickle(self):
         """Unpickle the underlying object"""
-        pik = decompress(self.pik) if self.compressed else self.pik
-        return pickle.loads(pik)
+        pik, buffers = _uncompress(self.pik, self.buffers, self.compressed)
+        return self._loads(pik, buffers)
+
+
+_PICKLED_NONE = Pickled(None)  # immutable, shared by the TASK_ENDED results
+
+
+class PickledDict(Pickled):
+    """
+    A Pickled dictionary knowing the pickled size of each value. The
+    keys and then the values are dumped with the same Pickler, so the
+    sizes are measured without pickling the values twice.
+
+    :param obj: the dictionary to pickle
+    :param shared: if True, large arrays are passed via shared memory
+    :param compress: if False, never compress (i.e. for local transfers)
+    """
+    def _dumps(self, dic, buffer_callback=None):
+        self.sizes = {}
+        buf = io.BytesIO()
+        pickler = pickle.Pickler(buf, _PROTOCOL,
+                                 buffer_callback=buffer_callback)
+        pickler.dump(list(dic))
+        for key, val in dic.items():
+            start, nbuf = buf.tell(), len(self.buffers)
+            pickler.dump(val)
+            self.sizes[key] = buf.tell() - start + sum(
+                memoryview(b).nbytes for b in self.buffers[nbuf:])
+        return buf.getvalue()
+
+    def _loads(self, pik, buffers):
+        unpickler = pickle.Unpickler(io.BytesIO(pik), buffers=buffers)
+        return {key: unpickler.load() for key in unpickler.load()}
+
+
+class SharedPickled(Pickled):
+    """
+    A Pickled object copied in a shared memory segment, so that it can be
+    sent to many tasks on the same host without copying it every time.
+    The segment must be released by the master when the tasks are done.
+
+    :param pik: a Pickled instance
+    """
+    def __init__(self, pik):
+        self.clsname = pik.clsname
+        self.calc_id = pik.calc_id
+        self.compressed = pik.compressed
+        chunks = [pik.pik] + [_raw(buf) for buf in pik.buffers]
+        self.sizes = [len(chunk) for chunk in chunks]
+        self.shm = _create_shm(max(sum(self.sizes), 1))
+        start = 0
+        for chunk, size in zip(chunks, self.sizes):
+            self.shm.buf[start:start + size] = chunk
+            start += size
+        self.name = self.shm.name
+
+    def __reduce_ex__(self, protocol):
+        state = vars(self).copy()
+        del state['shm']  # the segment is sent by name
+        return copyreg.__newobj__, (self.__class__,), state
+
+    def __len__(self):
+        return sum(self.sizes)
+
+    def unpickle(self):
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(self.name)
+        chunks = []
+        start = 0
+        try:
+            for size in self.sizes:
+                chunks.append(bytearray(shm.buf[start:start + size]))
+                start += size
+        finally:
+            shm.close()
+        pik, buffers = _uncompress(chunks[0], chunks[1:], self.compressed)
+        return pickle.loads(pik, buffers=buffers)
+
+    def release(self):
+        """
+        Release the shared memory segment (to be called in the master)
+        """
+        self.shm.close()
+        self.shm.unlink()
 
 
 def get_pickled_sizes(obj):
@@ -361,35 +644,139 @@ def get_pickled_sizes(obj):
     ('_start_time', 4), ('duration', 4)]
 
     Notice that the sizes depend on the operating system and the machine.
+    The attributes are pickled with the same Pickler in a single pass,
+    so subobjects shared by several attributes are counted only once.
     """
     sizes = []
     attrs = getattr(obj, '__dict__',  {})
+    buf = io.BytesIO()
+    pickler = pickle.Pickler(buf, _PROTOCOL)
     for name, value in attrs.items():
-        sizes.append((name, len(Pickled(value))))
+        start = buf.tell()
+        pickler.dump(value)
+        sizes.append((name, buf.tell() - start))
     return len(Pickled(obj)), sorted(
         sizes, key=lambda pair: pair[1], reverse=True)
 
 
-def pickle_sequence(objects):
+class _Blob(object):
+    """
+    Bytes of several objects pickled with the same Pickler, so that
+    their common subobjects are stored only once. The objects must be
+    unpickled in order, with the same Unpickler. As in Pickled, the large
+    buffers are kept out-of-band.
+
+    :param objs: the objects to pickle
+    :param compress: if False, never compress (i.e. for local transfers)
+    :param copy: if True, copy the out-of-band buffers
+    """
+    compressed = False
+
+    def __init__(self, objs, compress=True, copy=False):
+        self.copy = copy
+        self.buffers = []
+        self.pik, self.sizes = self._dump(objs, self._out_of_band)
+        if compress and len(self) > MB and config.distribution.compress:
+            self.pik, self.buffers = _compress(self.pik, self.buffers)
+            self.compressed = True
+        self.objs = []
+
+    _out_of_band = Pickled._out_of_band
+
+    def _dump(self, objs, buffer_callback=None):
+        # returns the pickled bytes and the size of each object
+        buf = io.BytesIO()
+        pickler = pickle.Pickler(buf, _PROTOCOL,
+                                 buffer_callback=buffer_callback)
+        sizes = []
+        for obj in objs:
+            start, nbuf = buf.tell(), len(self.buffers)
+            try:
+                pickler.dump(obj)
+            except TypeError as exc:  # can't pickle, show the obj
+                raise TypeError('%s: %s' % (exc, obj))
+            sizes.append(buf.tell() - start + sum(
+                memoryview(b).nbytes for b in self.buffers[nbuf:]))
+        return buf.getvalue(), sizes
+
+    def __len__(self):
+        return len(self.pik) + sum(
+            memoryview(buf).nbytes for buf in self.buffers)
+
+    def __reduce_ex__(self, protocol):
+        # the unpickled objects are not sent around
+        state = dict(compressed=self.compressed, pik=self.pik,
+                     buffers=self.buffers, sizes=self.sizes, objs=[])
+        if protocol < 5 and self.buffers:
+            # PickleBuffers can be pickled only with protocol 5
+            state['buffers'] = [bytes(buf) for buf in self.buffers]
+        return copyreg.__newobj__, (self.__class__,), state
+
+    def load(self, idx):
+        """
+        :returns: the object with the given index in the blob
+        """
+        if not self.objs:
+            pik, buffers = _uncompress(
+                self.pik, self.buffers, self.compressed)
+            self.unpickler = pickle.Unpickler(io.BytesIO(pik),
+                                              buffers=buffers)
+        while len(self.objs) <= idx:
+            self.objs.append(self.unpickler.load())
+        return self.objs[idx]
+
+
+class PickledView(Pickled):
+    """
+    A Pickled object stored as a slice of a _Blob shared with other
+    objects of the same sequence.
+    """
+    def __init__(self, obj, blob, idx, size):
+        self.clsname = obj.__class__.__name__
+        self.calc_id = str(getattr(obj, 'calc_id', ''))
+        self.blob = blob
+        self.idx = idx
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def unpickle(self):
+        return self.blob.load(self.idx)
+
+
+def pickle_sequence(objects, compress=True, copy=False):
     """
     Convert an iterable of objects into a list of pickled objects.
     If the iterable contains copies, the pickling will be done only once.
     If the iterable contains objects already pickled, they will not be
-    pickled again.
+    pickled again. The other objects are pickled with a single Pickler,
+    so that the subobjects they share are pickled only once.
 
     :param objects: a sequence of objects to pickle
+    :param compress: if False, never compress (i.e. for local transfers)
+    :param copy: if True, copy the out-of-band buffers
     """
     cache = {}
     out = []
+    todo = []  # objects to pickle
     for obj in objects:
         obj_id = id(obj)
         if obj_id not in cache:
             if isinstance(obj, Pickled):  # already pickled
                 cache[obj_id] = obj
-            else:  # pickle the object
-                cache[obj_id] = Pickled(obj)
-        out.append(cache[obj_id])
-    return out
+            else:  # pickle the object later
+                cache[obj_id] = len(todo)
+                todo.append(obj)
+        out.append(obj_id)
+    if todo:
+        blob = _Blob(todo, compress, copy)
+        views = [PickledView(obj, blob, i, size)
+                 for i, (obj, size) in enumerate(zip(todo, blob.sizes))]
+        for obj_id, val in cache.items():
+            if isinstance(val, int):
+                cache[obj_id] = views[val]
+    return [cache[obj_id] for obj_id in out]
 
 
 class FakePickle:
@@ -403,6 +790,34 @@ class FakePickle:
         return self.sentbytes
 
 
+def _check_master(mon):
+    # make sure the master and the worker are compatible
+    if mon.version and mon.version != engine_version():
+        raise RuntimeError(
+            'The master is at version %s while the worker %s is at '
+            'version %s' % (mon.version, socket.gethostname(),
+                            engine_version()))
+    if mon.config.dbserver.host != config.dbserver.host:
+        raise RuntimeError(
+            'The master has dbserver.host=%s while the worker has %s'
+            % (mon.config.dbserver.host, config.dbserver.host))
+
+
+# monitor attributes needed by the workers but not by the master
+_MON_SKIP = frozenset(['config', 'backurl', 'version', 'username', 'address',
+                       'h5', 'inject'])
+
+
+def _slim(mon):
+    # a copy of the monitor (and its children) to be sent back to the master
+    slim = object.__new__(mon.__class__)
+    vars(slim).update((k, v) for k, v in vars(mon).items()
+                      if k not in _MON_SKIP)
+    # the list is copied even if empty, since it can grow later
+    slim.children = [_slim(child) for child in mon.children]
+    return slim
+
+
 class Result(object):
     """
     :param val: value to return or exception instance
@@ -413,20 +828,29 @@ class Result(object):
     func = None
 
     def __init__(self, val, mon, tb_str='', msg=''):
+        # shared memory can be used only if the master is on the same host;
+        # in that case compressing the data would be a waste of time
+        backurl = getattr(mon, 'backurl', None) or ''
+        local = backurl.startswith('tcp://127.0.0.1')
+        shared = sys.platform == 'linux' and not tb_str and local
         if isinstance(val, dict):
-            self.pik = Pickled(val)
-            self.nbytes = {k: len(Pickled(v)) for k, v in val.items()}
+            self.pik = PickledDict(val, shared, not local)
+            self.nbytes = self.pik.sizes
         elif isinstance(val, tuple) and callable(val[0]):
             self.func = val[0]
-            self.pik = pickle_sequence(val[1:])
+            self.pik = pickle_sequence(val[1:], not local)
             self.nbytes = {'args': sum(len(p) for p in self.pik)}
         elif msg == 'TASK_ENDED':
-            self.pik = Pickled(None)
+            self.pik = _PICKLED_NONE
             self.nbytes = {}
         else:
-            self.pik = Pickled(val)
+            self.pik = Pickled(val, shared, not local)
             self.nbytes = {'tot': len(self.pik)}
-        self.mon = mon
+        # a snapshot of the monitor, since the result can be pickled later
+        # by another thread while the task changes the monitor; the
+        # configuration and the other monitor attributes used only in the
+        # workers are not sent back
+        self.mon = _slim(mon)
         self.tb_str = tb_str
         self.msg = msg
         self.workerid = (socket.gethostname(), os.getpid())
@@ -457,15 +881,7 @@ class Result(object):
         :returns: a new Result instance
         """
         try:
-            if mon.version and mon.version != engine_version():
-                raise RuntimeError(
-                    'The master is at version %s while the worker %s is at '
-                    'version %s' % (mon.version, socket.gethostname(),
-                                    engine_version()))
-            if mon.config.dbserver.host != config.dbserver.host:
-                raise RuntimeError(
-                    'The master has dbserver.host=%s while the worker has %s'
-                    % (mon.config.dbserver.host, config.dbserver.host))
+            _check_master(mon)
             with mon:
                 val = func(*args)
         except StopIteration:
@@ -480,13 +896,28 @@ class Result(object):
         return res
 
 
+_used_mem = [-numpy.inf, 0.]  # time of the measurement, used percent
+
+
+def _used_mem_percent(period=1.):
+    """
+    :param period: minimum number of seconds between two measurements
+    :returns: the percentage of the memory used in the current host
+    """
+    now = time.monotonic()
+    if now - _used_mem[0] >= period:
+        import psutil  # imported lazily since it is slow to import
+        _used_mem[:] = [now, psutil.virtual_memory().percent]
+    return _used_mem[1]
+
+
 def check_mem_usage(soft_percent=None, hard_percent=None):
     """
     Display a warning if we are running out of memory
     """
     soft_percent = soft_percent or config.memory.soft_mem_limit
     hard_percent = hard_percent or config.memory.hard_mem_limit
-    used_mem_percent = psutil.virtual_memory().percent
+    used_mem_percent = _used_mem_percent()
     if used_mem_percent > hard_percent:
         raise MemoryError('Using more memory than allowed by configuration '
                           '(Used: %d%% / Allowed: %d%%)! Shutting down.' %
@@ -502,6 +933,33 @@ dummy_mon.backurl = None
 DEBUG = False
 
 
+_zsockets = {}  # (thread id, backurl) -> PUSH socket reused by the tasks
+
+
+def _get_zsocket(backurl, maxsize=16):
+    # return a PUSH socket connected to the backurl, to be reused by all
+    # the tasks running in the same thread, so that each task does not pay
+    # for a new connection; zmq sockets are not thread-safe, so they are
+    # not shared between threads
+    key = (threading.get_ident(), backurl)
+    try:
+        return _zsockets[key]
+    except KeyError:
+        pass
+    from openquake.baselib.zeromq import zmq, Socket
+    if len(_zsockets) >= maxsize:  # close the oldest socket
+        _zsockets.pop(next(iter(_zsockets))).__exit__(None, None, None)
+    zsocket = _zsockets[key] = Socket(backurl, zmq.PUSH, 'connect')
+    return zsocket.__enter__()
+
+
+@atexit.register
+def _close_zsockets():
+    for zsocket in _zsockets.values():
+        zsocket.__exit__(None, None, None)
+    _zsockets.clear()
+
+
 def sendback(res, zsocket):
     """
     Send back to the master node the result by using the zsocket.
@@ -528,6 +986,98 @@ def sendback(res, zsocket):
     return nbytes
 
 
+class _BatchSender(object):
+    """
+    Send back the small results of a generator task in batches, i.e. as
+    lists of Result objects, to reduce the number of zmq messages.
+    Large results, subtasks and errors are sent immediately.
+    A batch is flushed after `max_delay` seconds by a long-lived thread
+    even if the generator is still computing the next value; the socket
+    is protected by a lock, so it is never used by two threads at once.
+
+    :param zsocket: a PUSH socket
+    :param maxsize: maximum number of results in a batch
+    :param max_delay: maximum time in seconds a batch is kept
+    """
+    deadlines = {}  # sender -> time when its batch must be flushed
+    cond = threading.Condition()  # protects the deadlines
+    flusher = None  # thread flushing the expired batches
+
+    def __init__(self, zsocket, maxsize=16, max_delay=.005):
+        self.zsocket = zsocket
+        self.maxsize = maxsize
+        self.max_delay = max_delay
+        self.batch = []
+        self.lock = threading.Lock()
+
+    def send(self, res):
+        """
+        :returns: the number of bytes sent or buffered
+        """
+        if res.func or res.tb_str or len(res.pik) > SHM_MIN_SIZE:
+            self.flush()
+            with self.lock:
+                return sendback(res, self.zsocket)
+        with self.lock:
+            self.batch.append(res)
+            full = len(self.batch) >= self.maxsize
+            if len(self.batch) == 1 and not full:
+                self._set_deadline(time.time() + self.max_delay)
+        if full:
+            self.flush()
+        return len(res.pik)
+
+    def _set_deadline(self, deadline):
+        cls = self.__class__
+        with cls.cond:
+            if cls.flusher is None or not cls.flusher.is_alive():
+                # started once per process (is_alive is False after a fork)
+                cls.flusher = threading.Thread(
+                    target=cls._flush_expired, daemon=True)
+                cls.flusher.start()
+            cls.deadlines[self] = deadline
+            cls.cond.notify()
+
+    @classmethod
+    def _flush_expired(cls):
+        # loop of the flusher thread; the senders are flushed without
+        # holding the condition, to avoid deadlocks with .send
+        while True:
+            with cls.cond:
+                now = time.time()
+                expired = [sender for sender, deadline in
+                           cls.deadlines.items() if deadline <= now]
+                if not expired:
+                    timeout = (min(cls.deadlines.values()) - now
+                               if cls.deadlines else None)
+                    cls.cond.wait(timeout)
+                    continue
+            for sender in expired:
+                sender.flush()
+
+    def flush(self):
+        """
+        Send the buffered results, if any
+        """
+        with self.lock:
+            with self.cond:
+                self.deadlines.pop(self, None)
+            if len(self.batch) == 1:
+                self.zsocket.send(self.batch[0])
+            elif self.batch:
+                self.zsocket.send(self.batch)
+            self.batch = []
+
+
+def _unbatch(results):
+    # yield the results received, expanding the batches
+    for res in results:
+        if isinstance(res, list):
+            yield from res
+        else:
+            yield res
+
+
 def safely_call(func, args, task_no=0, mon=dummy_mon):
     """
     Call the given function with the given arguments safely, i.e.
@@ -542,6 +1092,8 @@ def safely_call(func, args, task_no=0, mon=dummy_mon):
     :param mon: a monitor
     """
     isgenfunc = inspect.isgeneratorfunction(func)
+    if isinstance(mon, Pickled):  # pickled once by the Starmap
+        mon = mon.unpickle()
     if hasattr(args[0], 'unpickle'):
         # args is a list of Pickled objects
         args = [a.unpickle() for a in args]
@@ -561,28 +1113,41 @@ def safely_call(func, args, task_no=0, mon=dummy_mon):
     if mon.inject:
         args += (mon,)
     sentbytes = 0
+    zsocket = _get_zsocket(mon.backurl)
     if isgenfunc:
-        with Socket(mon.backurl, zmq.PUSH, 'connect') as zsocket:
+        sender = _BatchSender(zsocket)
+        try:
+            _check_master(mon)
             it = func(*args)
-            while True:
-                res = Result.new(next, (it,), mon, sentbytes)
-                # StopIteration -> TASK_ENDED
-                if res.msg == 'TASK_ENDED':
-                    zsocket.send(res)
-                    break
-                sentbytes += sendback(res, zsocket)
+            # the monitor is entered once for the whole task, not once
+            # per yielded value, and counts the yielded values; the time
+            # spent sending the results is not part of the task duration
+            sendtime = 0
+            try:
+                with mon:
+                    for val in it:
+                        mon.counts += 1
+                        t0 = time.time()
+                        sentbytes += sender.send(Result(val, mon))
+                        sendtime += time.time() - t0
+            finally:
+                mon.counts -= 1  # exiting the monitor does not count
+                mon.duration -= sendtime
+        except Exception:
+            _etype, exc, tb = sys.exc_info()
+            res = Result(exc, mon, ''.join(traceback.format_tb(tb)))
+            sentbytes += sender.send(res)
+        sender.flush()
+        end = Result(None, mon, msg='TASK_ENDED')
+        end.pik = FakePickle(sentbytes)
+        zsocket.send(end)
     else:
         res = Result.new(func, args, mon)
         # send back a single result and a TASK_ENDED
-        with Socket(mon.backurl, zmq.PUSH, 'connect') as zsocket:
-            sentbytes += sendback(res, zsocket)
-            end = Result(None, mon, msg='TASK_ENDED')
-            end.pik = FakePickle(sentbytes)
-            zsocket.send(end)
-
-
-if oq_distribute() == 'ipp':
-    from ipyparallel import Cluster
+        sentbytes += sendback(res, zsocket)
+        end = Result(None, mon, msg='TASK_ENDED')
+        end.pik = FakePickle(sentbytes)
+        zsocket.send(end)
 
 
 class IterResult(object):
@@ -594,7 +1159,7 @@ class IterResult(object):
     :param done_total:
         a function returning the number of done tasks and the total
     :param sent:
-        a nested dictionary name -> {argname: number of bytes sent}
+        a dictionary name -> (argnames, array of the number of bytes sent)
     :param progress:
         a logging function for the progress report
     :param hdf5path:
@@ -631,6 +1196,10 @@ class IterResult(object):
         try:
             yield from self._iter()
         finally:
+            # close the underlying generator also in case of errors, so
+            # that it can release its resources (i.e. shared memory)
+            if hasattr(self.iresults, 'close'):
+                self.iresults.close()
             items = sorted(self.nbytes.items(), key=operator.itemgetter(1))
             nb = {k: humansize(v) for k, v in list(reversed(items))[:3]}
             recv = sum(self.nbytes.values())
@@ -653,9 +1222,10 @@ class IterResult(object):
         Sum the data transfer information of a set of results
         """
         res = object.__new__(cls)
-        res.sent = 0
+        res.sent = AccumDict(accum=AccumDict())  # name -> argname -> nbytes
         for iresult in iresults:
-            res.sent += iresult.sent
+            for name, (argnames, nbytes) in iresult.sent.items():
+                res.sent[name] += dict(zip(argnames, nbytes))
             name = iresult.name.split('#', 1)[0]
             if hasattr(res, 'name'):
                 assert res.name.split('#', 1)[0] == name, (res.name, name)
@@ -676,6 +1246,7 @@ def getargnames(task_func):
         return inspect.getfullargspec(task_func.__call__).args[1:]
 
 
+@lru_cache(maxsize=4)  # resolved once per process, DNS lookups can be slow
 def get_return_ip(receiver_host):
     if receiver_host:
         return socket.gethostbyname(receiver_host)
@@ -683,41 +1254,56 @@ def get_return_ip(receiver_host):
     return socket.gethostbyname(hostname)
 
 
+def get_num_cores(cpu_max='/sys/fs/cgroup/cpu.max'):
+    """
+    :param cpu_max: path to the cgroup-v2 file with the CPU quota
+    :returns: the number of cores usable by the current process
+    """
+    # use only the "visible" cores, not the total system cores
+    # if the underlying OS supports it (macOS does not)
+    try:
+        num_cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        import psutil
+        num_cores = psutil.cpu_count()
+    # in containers the CPU quota can be smaller than the affinity
+    try:
+        with open(cpu_max) as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        return num_cores
+    if quota != 'max':
+        num_cores = min(num_cores, max(int(quota) // int(period), 1))
+    return num_cores
+
+
 class Starmap(object):
     pids = ()
-    running_tasks = []  # currently running tasks
+    running_tasks = set()  # currently running tasks
     maxtasksperchild = None  # with 1 it hangs on the EUR calculation!
-    num_cores = int(config.distribution.get('num_cores', '0'))
-    if not num_cores:
-        # use only the "visible" cores, not the total system cores
-        # if the underlying OS supports it (macOS does not)
-        try:
-            num_cores = len(psutil.Process().cpu_affinity())
-        except AttributeError:
-            num_cores = psutil.cpu_count()
+    num_cores = (int(config.distribution.get('num_cores', '0')) or
+                 get_num_cores())
     CT = num_cores * 2
 
     @classmethod
     def init(cls, distribute=None):
         cls.distribute = distribute or oq_distribute()
         if cls.distribute == 'processpool' and not hasattr(cls, 'pool'):
-            # unregister custom handlers before starting the processpool
-            term_handler = signal.signal(signal.SIGTERM, signal.SIG_DFL)
-            int_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
             # we use spawn here to avoid deadlocks with logging, see
             # https://github.com/gem/oq-engine/pull/3923 and
             # https://codewithoutrules.com/2018/09/04/python-multiprocessing/
-            cls.pool = mp_context.Pool(
-                cls.num_cores, init_workers,
-                maxtasksperchild=cls.maxtasksperchild)
-            cls.pids = [proc.pid for proc in cls.pool._pool]
-            # after spawning the processes restore the original handlers
-            # i.e. the ones defined in openquake.engine.engine
-            signal.signal(signal.SIGTERM, term_handler)
-            signal.signal(signal.SIGINT, int_handler)
+            kw = {}
+            if cls.maxtasksperchild:  # requires Python 3.11
+                kw['max_tasks_per_child'] = cls.maxtasksperchild
+            # the workers send their pids when they start
+            cls.pid_queue = mp_context.SimpleQueue()
+            cls.pool = ProcessPoolExecutor(
+                cls.num_cores, mp_context, init_workers, (cls.pid_queue,),
+                **kw)
         elif cls.distribute == 'threadpool' and not hasattr(cls, 'pool'):
-            cls.pool = multiprocessing.dummy.Pool(cls.num_cores)
+            cls.pool = ThreadPoolExecutor(cls.num_cores)
         elif cls.distribute == 'ipp' and not hasattr(cls, 'executor'):
+            from ipyparallel import Cluster
             rc = Cluster(n=cls.num_cores).start_and_connect_sync()
             cls.executor = rc.executor()
 
@@ -726,14 +1312,33 @@ class Starmap(object):
         # shutting down the pool during the runtime causes mysterious
         # race conditions with errors inside atexit._run_exitfuncs
         if hasattr(cls, 'pool'):
-            cls.pool.close()
-            cls.pool.terminate()
-            cls.pool.join()
+            pool = cls.pool
             del cls.pool
+            pool.shutdown(wait=False, cancel_futures=True)
+            for pid in cls.update_pids():  # kill the workers still running
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
             cls.pids = []
         elif hasattr(cls, 'executor'):
             cls.executor.shutdown()
 
+    @classmethod
+    def update_pids(cls):
+        """
+        Read the pids sent by the workers of the processpool when they
+        start and discard the pids of the workers which are dead
+
+        :returns: the list of the pids of the workers
+        """
+        pids = set(cls.pids)
+        queue = getattr(cls, 'pid_queue', None)
+        while queue is not None and not queue.empty():
+            pids.add(queue.get())
+        cls.pids = [pid for pid in sorted(pids) if memory_rss(pid)]
+        return cls.pids
+
     @classmethod
     def apply(cls, task, allargs, concurrent_tasks=None,
               maxweight=None, weight=lambda item: 1,
@@ -801,13 +1406,23 @@ class Starmap(object):
         self.task_args = task_args
         self.progress = progress
         self.h5 = h5
-        self.task_queue = []
+        self.task_queue = collections.deque()
         try:
             self.num_tasks = len(self.task_args)
         except TypeError:  # generators have no len
             self.num_tasks = None
         self.argnames = getargnames(task_func)
-        self.sent = AccumDict(accum=AccumDict())  # fname -> argname -> nbytes
+        self.sent = {}  # fname -> (argnames, array of nbytes)
+        self.task_sent = {}  # task_no -> (fname, list of nbytes)
+        # rows to be saved in the datasets of the same name
+        self.task_data = {'task_info': [], 'performance_data': [],
+                          'task_sent': []}
+        self.flush_time = time.time()
+        self.prev_args = {}  # id -> argument of the previous task
+        self.shared_args = {}  # id -> (argument, Pickled) shared by tasks
+        self.common_ids = set()  # ids of the arguments of several tasks
+        self.mem_time = -numpy.inf  # time of the last memory measurement
+        self.mem_cache = 0.
         self.monitor.inject = (self.argnames[-1].startswith('mon') or
                                self.argnames[-1].endswith('mon'))
         self.receiver = 'tcp://0.0.0.0:%s' % config.dbserver.receiver_ports
@@ -817,20 +1432,128 @@ class Starmap(object):
             self.return_ip = get_return_ip(config.dbserver.receiver_host)
             logging.debug(f'{self.return_ip=}')
         self.monitor.backurl = None  # overridden later
-        self.tasks = []  # populated by .submit
+        self.pickled_mons = {}  # operation -> Pickled monitor
+        self.sender = None  # thread sending the zmq tasks
+        self.sending = None  # future of the last task sent
+        self.tasks = set()  # numbers of the running tasks, set by .submit
         self.task_no = 0
+        # if OQ_TASK_NO is set, run only that task, in process, for debugging
+        task_no = os.environ.get('OQ_TASK_NO')
+        self.only_task_no = None if task_no is None else int(task_no)
+        # used in zmq mode to send more tasks to the faster hosts
+        self.host_speed = numpy.full(len(host_cores), numpy.nan)
+        self.host_credit = numpy.zeros(len(host_cores))
+        self.task_host = {}  # task_no -> host index
+        self.free_hosts = collections.deque()  # hosts which ended a task
+        # host index -> subtasks generated by the tasks on that host
+        self.host_queues = collections.defaultdict(collections.deque)
+
+    def next_host(self):
+        """
+        :returns:
+            the index of the host where to send the next task; if a host
+            has just ended a task it gets the next one (pull-based dispatch),
+            otherwise the host is chosen with a smooth weighted round robin
+            on the measured host speeds (on the number of cores at the start)
+        """
+        if self.free_hosts:
+            return self.free_hosts.popleft()
+        speed = self.host_speed.copy()
+        unknown = numpy.isnan(speed)
+        if unknown.all():
+            speed = host_ncores.copy()
+        elif unknown.any():  # use the mean speed per core of the others
+            speed_per_core = (speed[~unknown] / host_ncores[~unknown]).mean()
+            speed[unknown] = speed_per_core * host_ncores[unknown]
+        self.host_credit += speed
+        idx = self.host_credit.argmax()
+        self.host_credit[idx] -= speed.sum()
+        return idx
+
+    def update_speed(self, idx, mon, alpha=.3):
+        """
+        Update the moving average of the speed (weight per second) of the
+        host with index `idx`, which has run the task of the given monitor
+        """
+        if not mon.duration:
+            return
+        speed = getattr(mon, 'weight', 1.) / mon.duration
+        old = self.host_speed[idx]
+        self.host_speed[idx] = (
+            speed if numpy.isnan(old) else alpha * speed + (1 - alpha) * old)
+
+    def mem_gb(self, period=1.):
+        """
+        :param period: minimum number of seconds between two measurements
+        :returns: the memory used by the main process and the workers in GB
+        """
+        now = time.monotonic()
+        if now - self.mem_time < period:
+            return self.mem_cache
+        if sys.platform != 'darwin':
+            # it normally works on macOS, but not in notebooks calling
+            # notebooks, which is the case relevant for Marco Pagani
+            self.mem_cache = (memory_rss(os.getpid()) + sum(
+                memory_rss(pid) for pid in Starmap.update_pids())) / GB
+        else:
+            # measure only the memory used by the main process
+            self.mem_cache = memory_rss(os.getpid()) / GB
+        self.mem_time = now
+        return self.mem_cache
+
+    def save_task_data(self, res, name):
+        """
+        Buffer the information about the task that has just ended; the
+        buffers are saved by .flush_task_data
+
+        :param res: the TASK_ENDED Result
+        :param name: the name of the task
+        """
+        mon = res.mon
+        self.task_data['task_info'].append(
+            mon.get_task_info(res, name, self.mem_gb()))
+        self.task_data['performance_data'].extend(mon.pop_data().tolist())
+        if mon.task_no in self.task_sent:  # task distributed
+            fname, sent = self.task_sent.pop(mon.task_no)
+            argnames = self.sent[fname][0]
+            self.task_data['task_sent'].extend(
+                (fname, mon.task_no, argname, nbytes)
+                for argname, nbytes in zip(argnames, sent))
+
+    def flush_task_data(self, maxsize=64, period=5.):
+        """
+        Append the buffered information to the datasets task_info,
+        performance_data and task_sent, with a single write per dataset,
+        if there are more than maxsize tasks or if more than period seconds
+        passed from the previous flush; if maxsize is 0, always flush
+        """
+        ntasks = len(self.task_data['task_info'])
+        if not ntasks or (ntasks < maxsize and
+                          time.time() - self.flush_time < period):
+            return
+        for key, dt in [('task_info', task_info_dt),
+                        ('performance_data', perf_dt),
+                        ('task_sent', task_sent_dt)]:
+            rows = self.task_data[key]
+            if rows:
+                hdf5.extend(self.h5[key], numpy.array(rows, dt))
+                self.h5[key].flush()  # notify the reader
+                rows.clear()
+        self.flush_time = time.time()
 
     def log_percent(self):
         """
         Log the progress of the computation in percentage
         """
-        queued = len(self.task_queue)
         total = self.task_no
         done = total - len(self.tasks)
-        percent = int(float(done) / total * 100)
         if not hasattr(self, 'prev_percent'):  # first time
             self.prev_percent = 0
-        elif percent > self.prev_percent:
+        # integer comparison, true when done / total >= prev_percent + 1%
+        elif done * 100 >= (self.prev_percent + 1) * total:
+            percent = done * 100 // total
+            queued = len(self.task_queue) + sum(
+                len(queue) for queue in self.host_queues.values())
             self.progress('%s %3d%% [%d submitted, %d queued]',
                           self.name, percent, self.task_no, queued)
             self.prev_percent = percent
@@ -840,34 +1563,92 @@ class Starmap(object):
         """
         Submit the given arguments to the underlying task
         """
+        if (self.only_task_no is not None and
+                self.task_no != self.only_task_no):
+            self.task_no += 1
+            return
         func = func or self.task_func
         if not hasattr(self, 'socket'):  # setup the PULL socket the first time
+            from openquake.baselib.zeromq import zmq, Socket
             self.__class__.running_tasks = self.tasks
             self.socket = Socket(self.receiver, zmq.PULL, 'bind').__enter__()
             self.monitor.backurl = 'tcp://%s:%s' % (
                 self.return_ip, self.socket.port)
             self.monitor.config = config
-        OQ_TASK_NO = os.environ.get('OQ_TASK_NO')
-        if OQ_TASK_NO is not None and self.task_no != int(OQ_TASK_NO):
-            self.task_no += 1
-            return
-        dist = 'no' if self.num_tasks == 1 or OQ_TASK_NO else self.distribute
+        if self.num_tasks == 1 or self.only_task_no is not None:
+            dist = 'no'
+        else:
+            dist = self.distribute
         if dist != 'no':
             pickled = isinstance(args[0], Pickled)
             if not pickled:
                 assert not isinstance(args[-1], Monitor)  # sanity check
-                args = pickle_sequence(args)
-            if func is None:
-                fname = self.task_func.__name__
-                argnames = self.argnames[:-1]
-            else:
-                fname = func.__name__
-                argnames = getargnames(func)[:-1]
-            self.sent[fname] += {a: len(p) for a, p in zip(argnames, args)}
-        submit[dist](self, func, args, self.monitor)
-        self.tasks.append(self.task_no)
+                # the arguments are compressed only if sent to other hosts
+                local = dist in ('processpool', 'threadpool')
+                args = self.pickle_args(
+                    args, dist == 'processpool', not local)
+            fname = (func or self.task_func).__name__
+            if fname not in self.sent:
+                argnames = getargnames(func or self.task_func)[:-1]
+                self.sent[fname] = argnames, numpy.zeros(len(argnames), int)
+            argnames, totbytes = self.sent[fname]
+            sent = [len(p) for p in args[:len(argnames)]]
+            totbytes[:len(sent)] += sent
+            self.task_sent[self.task_no] = (fname, sent)
+        if dist in ('no', 'threadpool', 'slurm'):
+            mon = self.monitor
+        else:  # avoid pickling the monitor again for each task
+            mon = self.pickle_monitor()
+        submit[dist](self, func, args, mon)
+        self.tasks.add(self.task_no)
         self.task_no += 1
 
+    def pickle_monitor(self):
+        """
+        :returns: the monitor as a Pickled object, cached by operation
+        """
+        op = self.monitor.operation
+        if op not in self.pickled_mons:
+            self.pickled_mons[op] = Pickled(self.monitor)
+        return self.pickled_mons[op]
+
+    def pickle_args(self, args, shared=False, compress=True):
+        """
+        Pickle the arguments of a task. The arguments which are the same
+        objects in several tasks (or in consecutive tasks, if the tasks
+        are generated lazily) are pickled only once and, if shared is True
+        and they are large, they are stored in shared memory.
+
+        :param args: the arguments of a task
+        :param shared: if True, use shared memory for the common arguments
+        :param compress: if False, never compress the arguments
+        :returns: a list of Pickled objects
+        """
+        # the arguments are sent after this method returns (by the
+        # executor or by a background thread) so they must be copied,
+        # otherwise a change to an array would change the task input
+        prev, self.prev_args = self.prev_args, {}
+        objs = []
+        for arg in args:
+            key = id(arg)
+            if key in self.shared_args:
+                arg = self.shared_args[key][1]
+            elif key in prev or key in self.common_ids:
+                pik = Pickled(arg, compress=compress, copy=True)
+                if (shared and sys.platform == 'linux' and
+                        len(pik) > SHM_MIN_SIZE):
+                    try:
+                        pik = SharedPickled(pik)
+                    except OSError:  # for instance /dev/shm is full
+                        pass
+                # the original object is kept to avoid reusing its id
+                self.shared_args[key] = (arg, pik)
+                arg = pik
+            else:
+                self.prev_args[key] = arg
+            objs.append(arg)
+        return pickle_sequence(objs, compress, copy=True)
+
     def submit_split(self, args,  duration, outs_per_task):
         """
         Submit the given arguments to the underlying task
@@ -885,8 +1666,13 @@ class Starmap(object):
             for args in self.task_args:
                 self.submit(args)
         else:  # build a task queue in advance
-            self.task_queue = [(self.task_func, args)
-                               for args in self.task_args]
+            self.task_queue = collections.deque(
+                (self.task_func, args) for args in self.task_args)
+            # the arguments common to several tasks will be pickled once
+            counts = collections.Counter(
+                id(arg) for args in self.task_args
+                if not isinstance(args[0], Pickled) for arg in args)
+            self.common_ids = {key for key, n in counts.items() if n > 1}
         dist = 'no' if self.num_tasks == 1 else self.distribute
         if dist == 'slurm':
             for func, args in self.task_queue:
@@ -910,82 +1696,137 @@ class Starmap(object):
     def __iter__(self):
         return iter(self.submit_all())
 
+    def _next_queue(self):
+        # in zmq mode the subtasks are queued on the host of their parent
+        # task and they are sent there when the host becomes free; the
+        # other tasks are taken from the global queue and, if it is empty,
+        # from the host with more queued subtasks (work stealing)
+        if self.free_hosts:
+            queue = self.host_queues[self.free_hosts[0]]
+            if queue:
+                return queue
+        if self.task_queue:
+            return self.task_queue
+        return max(self.host_queues.values(), key=len,
+                   default=self.task_queue)
+
+    def wait_sent(self):
+        """
+        Wait until the last task is sent to the zmq workerpool,
+        raising an error if the sending failed
+        """
+        if self.sender is None:
+            self.sender = ThreadPoolExecutor(1)
+        if self.sending is not None:
+            sending, self.sending = self.sending, None
+            sending.result()
+
     def _submit_many(self, howmany):
         for _ in range(howmany):
-            if self.task_queue:
-                # remove in LIFO order
-                func, args = self.task_queue[0]
-                del self.task_queue[0]
+            queue = self._next_queue()
+            if queue:
+                # remove in FIFO order
+                func, args = queue.popleft()
                 self.submit(args, func=func)
 
     def _loop(self):
-        self.busytime = AccumDict(accum=[])  # pid -> time
+        # (host, pid) -> total time spent in the tasks
+        self.busytime = collections.defaultdict(float)
         dist = 'no' if self.num_tasks == 1 else self.distribute
         if dist == 'slurm':
             self.monitor.task_no = self.task_no  # total number of tasks
             sbatch(self.monitor)
                 
         elif self.task_queue:
-            first_args = self.task_queue[:self.CT]
-            self.task_queue[:] = self.task_queue[self.CT:]
+            first_args = [self.task_queue.popleft()
+                          for _ in range(min(self.CT, len(self.task_queue)))]
             for func, args in first_args:
                 self.submit(args, func=func)
 
         if not hasattr(self, 'socket'):  # no submit was ever made
             return ()
 
-        nbytes = sum(self.sent[self.task_func.__name__].values())
+        fname = self.task_func.__name__
+        nbytes = self.sent[fname][1].sum() if fname in self.sent else 0
         logging.warning('Sent %d %s tasks, %s', len(self.tasks),
                         self.name, humansize(nbytes))
+        try:
+            yield from self._receive()
+            self.log_percent()
+        finally:
+            # also when the consumer raises an error or stops iterating:
+            # the task data are needed to debug a failed calculation and
+            # the shared memory segments must not leak
+            try:
+                self.flush_task_data(maxsize=0)
+            finally:
+                self._cleanup()
+        if dist == 'slurm':
+            for fname in os.listdir(self.monitor.calc_dir):
+                os.remove(os.path.join(self.monitor.calc_dir, fname))
+        if len(self.busytime) > 1:
+            times = numpy.fromiter(self.busytime.values(), float)
+            logging.info(
+                'Mean time per core=%ds, std=%.1fs, min=%ds, max=%ds',
+                times.mean(), times.std(), times.min(), times.max())
 
-        isocket = iter(self.socket)  # read from the PULL socket
-        finished = set()
-        while self.tasks:
+    def _receive(self):
+        # yield the results, while submitting the pending tasks
+        isocket = _unbatch(self.socket)  # read from the PULL socket
+        pending = 0  # number of tasks to submit
+        while self.tasks or pending:
+            # submit the new tasks in bursts, after reading all the messages
+            # already received
+            if pending and (not self.tasks or pending >= self.CT or
+                            not self.socket.zsocket.poll(0)):
+                self._submit_many(pending)
+                pending = 0
+                continue
             self.log_percent()
+            if self.sending is not None:
+                self.wait_sent()
             res = next(isocket)
             if self.calc_id != res.mon.calc_id:
                 logging.warning('Discarding a result from job %s, since this '
                                 'is job %s', res.mon.calc_id, self.calc_id)
             elif res.msg == 'TASK_ENDED':
-                finished.add(res.mon.task_no)
-                self.busytime += {res.workerid: res.mon.duration}
+                self.busytime[res.workerid] += res.mon.duration
+                idx = self.task_host.pop(res.mon.task_no, None)
+                if idx is not None:  # zmq mode
+                    self.update_speed(idx, res.mon)
+                    self.free_hosts.append(idx)
                 self.tasks.remove(res.mon.task_no)
-                self._submit_many(1)
-                todo = set(range(self.task_no)) - finished
-                logging.debug('%d tasks todo %s', len(todo),
-                              shortlist(sorted(todo)))
-                task_sent = ast.literal_eval(decode(self.h5['task_sent'][()]))
-                task_sent.update(self.sent)
-                del self.h5['task_sent']
-                self.h5['task_sent'] = str(task_sent)
+                pending += 1
+                if logging.root.isEnabledFor(logging.DEBUG):
+                    logging.debug('%d tasks todo %s', len(self.tasks),
+                                  shortlist(sorted(self.tasks)))
                 name = res.mon.operation[6:]  # strip 'total '
                 n = self.name + ':' + name if name == 'split_task' else name
-                if sys.platform != 'darwin':
-                    # it normally works on macOS, but not in notebooks calling
-                    # notebooks, which is the case relevant for Marco Pagani
-                    mem_gb = (memory_rss(os.getpid()) + sum(
-                        memory_rss(pid) for pid in Starmap.pids)) / GB
-                else:
-                    # measure only the memory used by the main process
-                    mem_gb = memory_rss(os.getpid()) / GB
-                res.mon.save_task_info(self.h5, res, n, mem_gb)
-                res.mon.flush(self.h5)
+                self.save_task_data(res, n)
+                self.flush_task_data()
             elif res.func:  # add subtask
-                self.task_queue.append((res.func, res.pik))
-                self._submit_many(1)
+                idx = self.task_host.get(res.mon.task_no)
+                if idx is None:  # not in zmq mode
+                    self.task_queue.append((res.func, res.pik))
+                else:
+                    self.host_queues[idx].append((res.func, res.pik))
+                pending += 1
             else:
                 yield res
-        self.log_percent()
+
+    def _cleanup(self):
+        # release the socket, the sender and the shared memory segments
         self.socket.__exit__(None, None, None)
+        if self.sender is not None:
+            self.sender.shutdown()
+            self.sender = None
         self.tasks.clear()
-        if dist == 'slurm':
-            for fname in os.listdir(self.monitor.calc_dir):
-                os.remove(os.path.join(self.monitor.calc_dir, fname))
-        if len(self.busytime) > 1:
-            times = numpy.array(list(self.busytime.values()))
-            logging.info(
-                'Mean time per core=%ds, std=%.1fs, min=%ds, max=%ds',
-                times.mean(), times.std(), times.min(), times.max())
+        for _arg, pik in self.shared_args.values():
+            if isinstance(pik, SharedPickled):
+                pik.release()
+        self.shared_args.clear()
+        self.prev_args.clear()
+        self.common_ids.clear()
 
 
 def sequential_apply(task, args, concurrent_tasks=Starmap.CT,
@@ -1022,10 +1863,10 @@ def split_task(elements, func, args, duration, outs_per_task, monitor):
     n = len(elements)
     if outs_per_task > n:  # too many splits
         outs_per_task = n
-    elements = numpy.array(elements)  # from WeightedSequence to array
-    idxs = numpy.arange(n)
-    split_elems = [elements[idxs % outs_per_task == i]
-                   for i in range(outs_per_task)]
+    # from WeightedSequence to array; arrays are not copied
+    elements = numpy.asarray(elements)
+    # interleaved slices, to balance elements of different weights
+    split_elems = [elements[i::outs_per_task] for i in range(outs_per_task)]
     # see how long it takes to run the first slice
     t0 = time.time()
     for i, elems in enumerate(split_elems):
@@ -1035,6 +1876,8 @@ def split_task(elements, func, args, duration, outs_per_task, monitor):
         yield res
         if dt > duration:
             # spawn subtasks for the rest and exit, used in classical/case_14
+            # the common arguments are pickled only once for all subtasks
+            args = tuple(pickle_sequence(args))
             for els in split_elems[i + 1:]:
                 ls = List(els)
                 ls.weight = sum(getattr(el, 'weight', 1.) for el in els)
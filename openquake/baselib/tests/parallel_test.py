@@ -17,10 +17,13 @@
 # along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
 
 import platform
+import errno
+import signal
 import os
 import unittest.mock as mock
 import time
 import shutil
+import pickle
 import unittest
 import itertools
 import tempfile
@@ -55,6 +58,21 @@ def supertask(text, monitor):
             yield get_length, k * v
 
 
+def get_arange(n, monitor):
+    return {'arr': numpy.arange(n)}
+
+
+def get_sum(arr, i, monitor):
+    return {i: arr.sum()}
+
+
+def kill_worker(i, monitor):
+    # the first task kills its worker, the others check the SIGINT handler
+    if i == 0:
+        os._exit(1)
+    return {i: signal.getsignal(signal.SIGINT) is signal.SIG_IGN}
+
+
 def countletters(text1, text2, monitor):
     for block in general.block_splitter(text1 + text2, 5):
         yield get_length, ''.join(block)
@@ -67,6 +85,18 @@ class StarmapTestCase(unittest.TestCase):
     def setUpClass(cls):
         parallel.Starmap.init()  # initialize the pool
 
+    def test_broken_pool(self):
+        if parallel.Starmap.distribute != 'processpool':
+            raise unittest.SkipTest('not using the processpool')
+        smap = parallel.Starmap(kill_worker, [(0,), (1,)])
+        with self.assertRaises(parallel.BrokenProcessPool):
+            smap.reduce()
+        # the broken pool is replaced and the workers ignore SIGINT
+        res = parallel.Starmap(kill_worker, [(1,), (2,)]).reduce()
+        self.assertEqual(res, {1: True, 2: True})
+        pids = parallel.Starmap.update_pids()
+        self.assertTrue(0 < len(pids) <= parallel.Starmap.num_cores)
+
     def test_apply(self):
         res = parallel.Starmap.apply(
             get_length, (numpy.arange(10),), concurrent_tasks=3).reduce()
@@ -141,6 +171,45 @@ class StarmapTestCase(unittest.TestCase):
         smap = parallel.Starmap(countletters, data)
         self.assertEqual(smap.reduce(), {'n': 19})
 
+    def test_large_arrays(self):
+        # large arrays are sent back via shared memory
+        ns = [10, 100_000]
+        res = parallel.Starmap(get_arange, [(n,) for n in ns])
+        arrs = sorted((dic['arr'] for dic in res), key=len)
+        for n, arr in zip(ns, arrs):
+            numpy.testing.assert_equal(arr, numpy.arange(n))
+
+    def test_shared_args(self):
+        # the array common to all tasks is pickled only once
+        arr = numpy.arange(100_000)
+        smap = parallel.Starmap(get_sum, [(arr, i) for i in range(5)])
+        self.assertEqual(smap.reduce(), {i: arr.sum() for i in range(5)})
+        self.assertEqual(smap.shared_args, {})  # released at the end
+
+    def test_args_snapshot(self):
+        # the task arguments must not change if the arrays are changed
+        # after the submission, while the results are not copied
+        arr = numpy.arange(100_000)
+        smap = parallel.Starmap(get_sum, [(arr, 0), (arr, 1)])
+        arr2 = arr.copy()
+        smap.common_ids = {id(arr)}  # pickled alone, arr2 in a _Blob
+        piks = smap.pickle_args((arr, arr2))
+        arr[:] = 0
+        arr2[:] = 0
+        for pik in piks:
+            self.assertEqual(pik.unpickle().sum(), 4999950000)
+        res = parallel.Result(arr, performance.Monitor())
+        self.assertIsInstance(res.pik.buffers[0], pickle.PickleBuffer)
+
+    def test_shared_args_error(self):
+        # the shared memory is released even if the consumer fails
+        arr = numpy.arange(100_000)
+        smap = parallel.Starmap(get_sum, [(arr, i) for i in range(5)])
+        with self.assertRaises(ZeroDivisionError):
+            for res in smap:
+                1 / 0
+        self.assertEqual(smap.shared_args, {})
+
     @classmethod
     def tearDownClass(cls):
         parallel.Starmap.shutdown()
@@ -163,6 +232,250 @@ class ThreadPoolTestCase(unittest.TestCase):
                 parallel.Starmap.shutdown()
 
 
+class PickleSequenceTestCase(unittest.TestCase):
+    def test_shared_subobjects(self):
+        arr = numpy.arange(1000)
+        dic = {'arr': arr}
+        pik = parallel.pickle_sequence([dic, [arr], dic])
+        self.assertIs(pik[0], pik[2])
+        self.assertLess(len(pik[1]), 100)  # the array is not pickled again
+        objs = [p.unpickle() for p in pickle.loads(pickle.dumps(pik))]
+        self.assertIs(objs[0]['arr'], objs[1][0])
+        numpy.testing.assert_equal(objs[1][0], arr)
+
+    def test_pickled_dict(self):
+        arr = numpy.arange(100_000)
+        pik = parallel.PickledDict({'arr': arr, 'lst': [arr], 'x': 'x'})
+        self.assertGreater(pik.sizes['arr'], arr.nbytes)
+        self.assertLess(pik.sizes['lst'], 100)  # arr is not pickled again
+        dic = pickle.loads(pickle.dumps(pik)).unpickle()
+        self.assertEqual(list(dic), ['arr', 'lst', 'x'])
+        self.assertIs(dic['arr'], dic['lst'][0])
+        numpy.testing.assert_equal(dic['arr'], arr)
+
+    def test_result_monitor(self):
+        mon = performance.Monitor('test')
+        mon.config = parallel.config
+        mon.backurl = 'tcp://127.0.0.1:1912'
+        with mon('child'):
+            pass
+        res = pickle.loads(pickle.dumps(parallel.Result(None, mon)))
+        self.assertFalse(hasattr(res.mon, 'config'))
+        self.assertFalse(hasattr(res.mon.children[0], 'config'))
+        self.assertEqual(res.mon.pop_data()['operation'], [b'child'])
+
+    def test_compress(self):
+        arr = numpy.zeros(1_000_000)
+        self.assertTrue(parallel.Pickled(arr).compressed)
+        pik = parallel.Pickled(arr, compress=False)
+        self.assertFalse(pik.compressed)
+        numpy.testing.assert_equal(pik.unpickle(), arr)
+        [view] = parallel.pickle_sequence([arr])
+        self.assertTrue(view.blob.compressed)
+        numpy.testing.assert_equal(view.unpickle(), arr)
+
+
+@unittest.skipUnless(sys.platform == 'linux', 'no /dev/shm')
+class SharedMemoryTestCase(unittest.TestCase):
+    enospc = OSError(errno.ENOSPC, 'No space left on device')
+
+    def test_full_shm(self):
+        # a full /dev/shm must not give a SIGBUS: the array is pickled
+        arr = numpy.arange(100_000)
+        before = set(os.listdir('/dev/shm'))
+        with mock.patch('os.posix_fallocate', side_effect=self.enospc):
+            self.assertIs(parallel._shm_dump(arr), arr)
+        self.assertEqual(set(os.listdir('/dev/shm')), before)
+
+    def test_full_shm_args(self):
+        # the common arguments are pickled normally if they do not fit
+        arr = numpy.arange(100_000)
+        smap = parallel.Starmap(get_sum, [(arr, 0), (arr, 1)])
+        smap.prev_args = {id(arr): arr}
+        with mock.patch('os.posix_fallocate', side_effect=self.enospc):
+            pik = smap.pickle_args((arr, 1), shared=True)
+        self.assertNotIsInstance(smap.shared_args[id(arr)][1],
+                                 parallel.SharedPickled)
+        numpy.testing.assert_equal(pik[0].unpickle(), arr)
+
+
+def slowgen(monitor):
+    # a generator sleeping between the yields
+    for i in range(3):
+        yield i
+        time.sleep(.2)
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []  # pairs (time, obj)
+
+    def send(self, obj):
+        self.sent.append((time.time(), obj))
+
+
+class BatchSenderTestCase(unittest.TestCase):
+
+    def test_max_delay(self):
+        # a small result must not wait for the next value of the generator
+        zsocket = FakeSocket()
+        sender = parallel._BatchSender(zsocket, max_delay=.01)
+        mon = performance.Monitor()
+        t0 = time.time()
+        flushers = set()
+        for val in slowgen(mon):
+            sender.send(parallel.Result(val, mon))
+            flushers.add(parallel._BatchSender.flusher)
+        sender.flush()
+        self.assertEqual([obj.get() for _, obj in zsocket.sent], [0, 1, 2])
+        for i, (t, _) in enumerate(zsocket.sent):
+            self.assertLess(t - t0, .2 * i + .1)
+        self.assertEqual(len(flushers), 1)  # a single long-lived thread
+
+    def test_snapshot(self):
+        # the monitor can change while the result waits in the batch
+        mon = performance.Monitor()
+        res = parallel.Result(1, mon)
+        mon.counts += 1
+        with mon('child'):
+            pass
+        self.assertEqual(res.mon.counts, 0)
+        self.assertEqual(res.mon.children, [])
+
+    def test_maxsize(self):
+        zsocket = FakeSocket()
+        sender = parallel._BatchSender(zsocket, maxsize=3, max_delay=10)
+        mon = performance.Monitor()
+        for i in range(7):
+            sender.send(parallel.Result(i, mon))
+        sender.flush()
+        sent = [obj for _, obj in zsocket.sent]
+        self.assertEqual([len(res) for res in sent[:2]], [3, 3])
+        self.assertEqual(sent[2].get(), 6)
+        self.assertNotIn(sender, parallel._BatchSender.deadlines)
+
+
+def failgen(text, monitor):
+    # a generator failing after yielding the characters
+    yield from text
+    1/0
+
+
+class SafelyCallTestCase(unittest.TestCase):
+
+    def test_generator(self):
+        # the counts are right also in case of error and the time spent
+        # in sending the results is not part of the task duration
+        zsocket = FakeSocket()
+        mon = performance.Monitor('failgen')
+        mon.backurl = 'tcp://127.0.0.1:1'
+        mon.config = parallel.config
+        mon.inject = True
+
+        def slow_send(sender, res):
+            time.sleep(.1)
+            return 0
+        with mock.patch.object(parallel, '_get_zsocket',
+                               lambda url: zsocket), \
+                mock.patch.object(parallel._BatchSender, 'send', slow_send):
+            parallel.safely_call(failgen, ('ab',), 0, mon)
+        end = zsocket.sent[-1][1]
+        self.assertEqual(end.msg, 'TASK_ENDED')
+        self.assertEqual(end.mon.counts, 2)
+        self.assertLess(end.mon.duration, .1)
+
+
+@mock.patch('os.sched_getaffinity', lambda pid: set(range(8)), create=True)
+class NumCoresTestCase(unittest.TestCase):
+    # reading the CPU quota from a cgroup-v2 cpu.max file
+
+    def get_num_cores(self, content):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'cpu.max')
+            if content is not None:
+                with open(fname, 'w') as f:
+                    f.write(content)
+            return parallel.get_num_cores(fname)
+
+    def test_max(self):
+        self.assertEqual(self.get_num_cores('max 100000\n'), 8)
+
+    def test_quota(self):
+        self.assertEqual(self.get_num_cores('250000 100000\n'), 2)
+
+    def test_quota_below_one_core(self):
+        self.assertEqual(self.get_num_cores('50000 100000\n'), 1)
+
+    def test_missing_file(self):
+        self.assertEqual(self.get_num_cores(None), 8)
+
+
+@mock.patch.multiple(parallel, host_cores=['h0 4', 'h1 2', 'h2 2'],
+                     host_ncores=numpy.array([4, 2, 2]))
+class SchedulerTestCase(unittest.TestCase):
+    # the host scheduling used in zmq mode, with fake hosts
+
+    def get_smap(self):
+        return parallel.Starmap(get_length, [('a',), ('b',)], distribute='no')
+
+    def test_round_robin_cores(self):
+        # at the start the tasks are distributed on the number of cores
+        smap = self.get_smap()
+        hosts = [smap.next_host() for _ in range(8)]
+        self.assertEqual(hosts, [0, 1, 2, 0, 0, 1, 2, 0])
+
+    def test_round_robin_speed(self):
+        # the faster hosts get more tasks; the unknown speed of h2 is
+        # estimated from the mean speed per core of the other hosts
+        smap = self.get_smap()
+        for idx, weight in [(0, 3.), (1, 1.)]:
+            mon = performance.Monitor()
+            mon.weight = weight
+            mon.duration = 1.
+            smap.update_speed(idx, mon)
+        numpy.testing.assert_equal(smap.host_speed, [3., 1., numpy.nan])
+        hosts = [smap.next_host() for _ in range(21)]
+        self.assertEqual(list(numpy.bincount(hosts)), [12, 4, 5])
+
+    def test_update_speed(self):
+        smap = self.get_smap()
+        mon = performance.Monitor()
+        mon.weight = 10.
+        mon.duration = 0.  # ignored
+        smap.update_speed(0, mon)
+        self.assertTrue(numpy.isnan(smap.host_speed[0]))
+        mon.duration = 1.
+        smap.update_speed(0, mon)
+        mon.duration = 2.
+        smap.update_speed(0, mon)  # moving average
+        self.assertAlmostEqual(smap.host_speed[0], .3 * 5. + .7 * 10.)
+
+    def test_free_hosts(self):
+        # the hosts which ended a task get the next ones, in order
+        smap = self.get_smap()
+        smap.free_hosts.extend([2, 1])
+        self.assertEqual([smap.next_host() for _ in range(3)], [2, 1, 0])
+        self.assertEqual(list(smap.host_credit), [-4, 2, 2])
+
+    def test_work_stealing(self):
+        smap = self.get_smap()
+        submitted = []  # pairs (argument, host)
+
+        def submit(args, func=None):
+            submitted.append((args[0], smap.next_host()))
+        smap.submit = submit
+        smap.task_queue.append((get_length, ('t',)))
+        smap.host_queues[2].extend((get_length, (s,)) for s in 'abc')
+        smap.free_hosts.extend([2, 1])
+        smap._submit_many(5)
+        # the subtasks go on the host of their parent when it is free,
+        # the free host 1 takes the task in the global queue and then
+        # the remaining subtasks are stolen by the other hosts
+        self.assertEqual(submitted, [('a', 2), ('t', 1), ('b', 0),
+                                     ('c', 1)])
+        self.assertEqual(len(smap._next_queue()), 0)
+
+
 def sum_chunk(slc, hdf5path):
     with hdf5.File(hdf5path, 'r') as f:
         return f['array'][slc].sum()
@@ -188,6 +501,20 @@ class SWMRTestCase(unittest.TestCase):
             h['array'] = numpy.arange(100)
         performance.init_performance(cls.tmp)
 
+    def test_flush_on_error(self):
+        # the task_info of the completed tasks is saved even if the
+        # consumer fails
+        with hdf5.File(self.tmp, 'a') as h5, mock.patch.dict(
+                os.environ, {'OQ_DISTRIBUTE': 'no'}):
+            n = len(h5['task_info'])
+            smap = parallel.Starmap(get_sum, [(numpy.arange(10), i)
+                                              for i in range(5)], h5=h5)
+            with self.assertRaises(ZeroDivisionError):
+                for i, res in enumerate(smap):
+                    if i == 1:
+                        1 / 0
+            self.assertEqual(len(h5['task_info']) - n, 1)
+
     def test(self):
         allargs = []
         for s in range(0, 100, 10):
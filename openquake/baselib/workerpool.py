@@ -236,7 +236,7 @@ def errback(job_id, task_no, exc):
     from openquake.commonlib.logs import dbcmd
     dbcmd('log', job_id, datetime.utcnow(), 'ERROR',
           '%s/%s' % (job_id, task_no), str(exc))
-    e = exc.__class__('in job %d, task %d' % (job_id, task_no))
+    e = exc.__class__('in job %s, task %d' % (job_id, task_no))
     raise e.with_traceback(exc.__traceback__)
 
 
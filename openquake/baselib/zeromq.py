@@ -32,6 +32,7 @@ with Socket('tcp://0.0.0.0:8000', zmq.REP, 'bind') as sock:
 import re
 import zmq
 import time
+import pickle
 import logging
 
 context = zmq.Context()
@@ -46,6 +47,27 @@ class TimeoutError(RuntimeError):
     pass
 
 
+def dumps(obj):
+    """
+    Pickle an object with protocol 5, keeping the buffers out-of-band.
+
+    :returns: a list of frames, the pickle followed by the buffers
+    """
+    buffers = []
+    pik = pickle.dumps(obj, 5, buffer_callback=buffers.append)
+    return [pik] + [buf.raw() for buf in buffers]
+
+
+def loads(frames):
+    """
+    Unpickle a list of frames produced by :func:`dumps`; the buffers
+    are copied into bytearrays, so that the arrays built on them are
+    writeable.
+    """
+    return pickle.loads(frames[0].buffer,
+                        buffers=[bytearray(f.buffer) for f in frames[1:]])
+
+
 def bind(end_point, socket_type):
     """
     Bind to a zmq URL; raise a proper error if the URL is invalid; return
@@ -152,13 +174,19 @@ class Socket(object):
         self.running = True
         while self.running:
             try:
-                if self.zsocket.poll(self.timeout):
-                    yield self.zsocket.recv_pyobj()
-                elif self.socket_type == zmq.PULL:
-                    logging.debug('Waiting on %s:%d', self, self.port)
+                try:  # read the queued messages without polling
+                    frames = self.zsocket.recv_multipart(
+                        zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    if not self.zsocket.poll(self.timeout):
+                        if self.socket_type == zmq.PULL:
+                            logging.debug('Waiting on %s:%d', self, self.port)
+                        continue
+                    frames = self.zsocket.recv_multipart(copy=False)
             except zmq.ZMQError:
                 # sending SIGTERM raises ZMQError
                 break
+            yield loads(frames)
 
     def send(self, obj):
         """
@@ -169,7 +197,7 @@ class Socket(object):
             the Python object to send
         """
         try:
-            self.zsocket.send_pyobj(obj)
+            self.zsocket.send_multipart(dumps(obj))
         except Exception as exc:
             # usual for objects bigger than 4 GB
             raise exc.__class__('%s: %r' % (exc, obj))
@@ -179,7 +207,7 @@ class Socket(object):
             if not ok:
                 raise TimeoutError('While sending %r to %s' %
                                    (obj, self.end_point))
-            return self.zsocket.recv_pyobj()
+            return loads(self.zsocket.recv_multipart(copy=False))
 
     def __repr__(self):
         return '<%s %s %s>' % (self.__class__.__name__,
@@ -25,7 +25,6 @@ import psutil
 import logging
 import operator
 import numpy
-import pandas
 from PIL import Image
 from openquake.baselib import (
     performance, parallel, hdf5, config, python3compat)
@@ -36,9 +35,10 @@ from openquake.hazardlib.contexts import read_cmakers, get_maxsize
 from openquake.hazardlib.calc.hazard_curve import classical as hazclassical
 from openquake.hazardlib.calc import disagg
 from openquake.hazardlib.probability_map import ProbabilityMap, rates_dt
-from openquake.commonlib import calc
+from openquake.commonlib import calc, datastore
 from openquake.calculators import base, getters
 
+U8 = numpy.uint8
 U16 = numpy.uint16
 U32 = numpy.uint32
 F32 = numpy.float32
@@ -85,32 +85,67 @@ class Set(set):
 
 def store_ctxs(dstore, rupdata_list, grp_id):
     """
-    Store contexts in the datastore
+    Store contexts in the datastore, with a single write per parameter
     """
-    for rupdata in rupdata_list:
-        nr = len(rupdata)
-        known = set(rupdata.dtype.names)
-        for par in dstore['rup']:
-            if par == 'grp_id':
-                hdf5.extend(dstore['rup/grp_id'], numpy.full(nr, grp_id))
-            elif par == 'probs_occur':
-                dstore.hdf5.save_vlen('rup/probs_occur', rupdata[par])
-            elif par in known:
-                hdf5.extend(dstore['rup/' + par], rupdata[par])
-            else:
-                hdf5.extend(dstore['rup/' + par], numpy.full(nr, numpy.nan))
+    rupdata_list = [rupdata for rupdata in rupdata_list if len(rupdata)]
+    if not rupdata_list:
+        return
+    nr = sum(len(rupdata) for rupdata in rupdata_list)
+    for par in dstore['rup']:
+        dset = dstore['rup/' + par]
+        if par == 'grp_id':
+            hdf5.extend(dset, numpy.full(nr, grp_id, dset.dtype))
+        elif par == 'probs_occur':
+            arrays = [rupdata[par] for rupdata in rupdata_list]
+            if len(set(arr.shape[1:] for arr in arrays)) == 1:
+                data = numpy.concatenate(arrays)
+            else:  # different number of occurrences in different chunks
+                data = [probs for arr in arrays for probs in arr]
+            dstore.hdf5.save_vlen('rup/probs_occur', data)
+        else:
+            # fill a single buffer of the right dtype, broadcasting NaN
+            # on the chunks missing the parameter
+            data = numpy.empty((nr,) + dset.shape[1:], dset.dtype)
+            start = 0
+            for rupdata in rupdata_list:
+                stop = start + len(rupdata)
+                if par in rupdata.dtype.names:
+                    data[start:stop] = rupdata[par]
+                else:
+                    data[start:stop] = numpy.nan
+                start = stop
+            hdf5.extend(dset, data)
 
 
-def to_rates(pnemap, gid, tiling, disagg_by_src):
+def to_rates(pmap, gid, tiling, disagg_by_src):
     """
+    :param pmap: ProbabilityMap with PoEs
     :returns: dictionary if tiling is True, else ProbabilityMap with rates
     """
-    rates = pnemap.to_rates()
     if tiling:
-        return rates.to_dict(gid)
+        return pmap.to_rates_dict(gid)
     if disagg_by_src:
-        return rates
-    return rates.remove_zeros()
+        return pmap.poes_to_rates()
+    # discard the sites with zero PoEs first, so that the logarithms are
+    # computed only on the affected sites
+    return pmap.remove_zeros().poes_to_rates()
+
+
+_sources_cache = {}  # (filename, grp_id) -> sources, at most one group
+
+
+def _load_sources(filename, grp_id):
+    # a worker receiving several tiles of the same group decompresses and
+    # unpickles the sources only once; only the last group is kept, since
+    # the sources use a lot of RAM, and it is discarded as soon as a task
+    # of another group or of another calculation arrives
+    key = filename, grp_id
+    if key not in _sources_cache:
+        _sources_cache.clear()  # release the memory before reading
+        with datastore.read(filename) as dstore:
+            arr = dstore.getitem('_csm')[grp_id]
+        _sources_cache[key] = pickle.loads(zlib.decompress(arr.tobytes()))
+    return _sources_cache[key]
 
 #  ########################### task functions ############################ #
 
@@ -123,14 +158,13 @@ def classical(sources, sitecol, cmaker, dstore, monitor):
     cmaker.init_monitoring(monitor)
     tiling = not hasattr(sources, '__iter__')  # passed gid
     disagg_by_src = cmaker.disagg_by_src
-    with dstore:
-        if tiling:  # tiling calculator, read the sources from the datastore
-            gid = sources
-            with monitor('reading sources'):  # fast, but uses a lot of RAM
-                arr = dstore.getitem('_csm')[cmaker.grp_id]
-                sources = pickle.loads(zlib.decompress(arr.tobytes()))
-        else:  # regular calculator
-            gid = 0
+    if tiling:  # tiling calculator, read the sources from the datastore
+        gid = sources
+        with monitor('reading sources'):  # fast, but uses a lot of RAM
+            sources = _load_sources(dstore.filename, cmaker.grp_id)
+    else:  # regular calculator
+        gid = 0
+        with dstore:
             sitecol = dstore['sitecol']  # super-fast
 
     if disagg_by_src and not getattr(sources, 'atomic', False):
@@ -142,7 +176,7 @@ def classical(sources, sitecol, cmaker, dstore, monitor):
                 sitecol.sids, cmaker.imtls.size, len(cmaker.gsims)).fill(
                 cmaker.rup_indep)
             result = hazclassical(srcs, sitecol, cmaker, pmap)
-            result['pnemap'] = to_rates(~pmap, gid, tiling, disagg_by_src)
+            result['pnemap'] = to_rates(pmap, gid, tiling, disagg_by_src)
             yield result
     else:
         # size_mb is the maximum size of the pmap array in GB
@@ -159,7 +193,7 @@ def classical(sources, sitecol, cmaker, dstore, monitor):
                 sites.sids, cmaker.imtls.size, len(cmaker.gsims)).fill(
                     cmaker.rup_indep)
             result = hazclassical(sources, sites, cmaker, pmap)
-            result['pnemap'] = to_rates(~pmap, gid, tiling, disagg_by_src)
+            result['pnemap'] = to_rates(pmap, gid, tiling, disagg_by_src)
             yield result
 
 
@@ -212,7 +246,7 @@ def postclassical(pgetter, N, hstats, individual_rlzs,
             if amplifier:
                 pc = amplifier.amplify(ampcode[sid], pc)
                 # NB: the hcurve have soil levels != IMT levels
-        if pc.array.sum() == 0:  # no data
+        if not pc.array.any():  # no data
             continue
         with compute_mon:
             if R == 1 or individual_rlzs:
@@ -237,13 +271,22 @@ def postclassical(pgetter, N, hstats, individual_rlzs,
     return pmap_by_kind
 
 
+def quantize(array, vmin, vmax):
+    """
+    :returns: the indices (0..255) of the values in 256 bins in [vmin, vmax]
+    """
+    delta = (vmax - vmin) or 1.
+    return numpy.clip((F64(array) - vmin) / delta * 256, 0, 255).astype(U8)
+
+
 def make_hmap_png(hmap, lons, lats):
     """
     :param hmap:
-        a dictionary with keys calc_id, m, p, imt, poe, inv_time, array
+        a dictionary with keys calc_id, m, p, imt, poe, inv_time, array,
+        vmin, vmax, where array contains values quantized in 256 bins
     :param lons: an array of longitudes
     :param lats: an array of latitudes
-    :returns: an Image object containing the hazard map
+    :returns: a dictionary with the hazard map encoded as PNG bytes
     """
     import matplotlib.pyplot as plt
     fig = plt.figure()
@@ -252,11 +295,24 @@ def make_hmap_png(hmap, lons, lats):
     ax.set_title('hmap for IMT=%(imt)s, poe=%(poe)s\ncalculation %(calc_id)d,'
                  'inv_time=%(inv_time)dy' % hmap)
     ax.set_ylabel('Longitude')
-    coll = ax.scatter(lons, lats, c=hmap['array'], cmap='jet')
+    vmin, vmax = hmap['vmin'], hmap['vmax']
+    if vmax > vmin:
+        # the colormap has 256 colors, so taking the center of the bins
+        # gives the same colors as the original values
+        values = vmin + (hmap['array'] + .5) * (vmax - vmin) / 256
+        coll = ax.scatter(lons, lats, c=values, cmap='jet',
+                          vmin=vmin, vmax=vmax)
+    else:  # constant map
+        values = numpy.full(len(hmap['array']), vmin)
+        coll = ax.scatter(lons, lats, c=values, cmap='jet')
     plt.colorbar(coll)
     bio = io.BytesIO()
-    plt.savefig(bio, format='png')
-    return dict(img=Image.open(bio), m=hmap['m'], p=hmap['p'])
+    # the PNG is decoded by the master, so use the fastest compression
+    fig.savefig(bio, format='png', pil_kwargs={'compress_level': 1})
+    plt.close(fig)  # the workers are reused, do not accumulate figures
+    # NB: returning the PNG bytes is much lighter than returning an Image,
+    # which would be pickled as raw pixels
+    return dict(png=bio.getvalue(), m=hmap['m'], p=hmap['p'])
 
 
 class Hazard:
@@ -288,7 +344,11 @@ class Hazard:
         :returns: an array of rates of shape (N, M, L1)
         """
         gids = self.gids[grp_id]
-        rates = pmap.array @ self.weig[gids] / self.itime
+        # dividing the G weights by itime instead of the (N, L) rates and
+        # using the dtype of the array (float32) avoids a float64 copy of
+        # the (N, L, G) array; the result is accumulated in float64
+        weig = (self.weig[gids] / self.itime).astype(pmap.array.dtype)
+        rates = F64(pmap.array @ weig)
         return rates.reshape((self.N, self.M, self.L1))
 
     def store_rates(self, pnemap):
@@ -326,13 +386,16 @@ class Hazard:
         """
         Store data inside mean_rates_by_src with shape (N, M, L1, Ns)
         """
-        mean_rates_by_src = self.datastore['mean_rates_by_src/array'][()]
+        # the dataset is created full of zeros by the calculator (in
+        # init_poes) and written only here, so there is no need to read it
+        dset = self.datastore['mean_rates_by_src/array']
+        mean_rates_by_src = numpy.zeros(dset.shape, dset.dtype)
         for key, rates in dic.items():
             if isinstance(key, str):
                 # in case of mean_rates_by_src key is a source ID
                 idx = self.srcidx[valid.corename(key)]
                 mean_rates_by_src[..., idx] += rates
-        self.datastore['mean_rates_by_src/array'][:] = mean_rates_by_src
+        dset[:] = mean_rates_by_src
         return mean_rates_by_src
 
 
@@ -364,8 +427,8 @@ class ClassicalCalculator(base.HazardCalculator):
         self.rel_ruptures[grp_id] += sum(sdata['nrupts'])
         cfactor = dic.pop('cfactor')
         if cfactor[1] != cfactor[0]:
-            print('ctxs_per_mag = {:.0f}, cfactor_per_task = {:.1f}'.format(
-                cfactor[1] / cfactor[2], cfactor[1] / cfactor[0]))
+            logging.debug('ctxs_per_mag = %.0f, cfactor_per_task = %.1f',
+                          cfactor[1] / cfactor[2], cfactor[1] / cfactor[0])
         self.cfactor += cfactor
 
         # store rup_data if there are few sites
@@ -378,11 +441,7 @@ class ClassicalCalculator(base.HazardCalculator):
         if source_id:
             # accumulate the rates for the given source
             acc[source_id] += self.haz.get_rates(pnemap, grp_id)
-        G = pnemap.array.shape[2]
-        rates = self.pmap.array
-        sidx = self.pmap.sidx[pnemap.sids]
-        for i, gid in enumerate(self.gids[grp_id]):
-            rates[sidx, :, gid] += pnemap.array[:, :, i % G]
+        self.pmap.add_rates(pnemap, self.gids[grp_id])
         return acc
 
     def create_rup(self):
@@ -473,6 +532,9 @@ class ClassicalCalculator(base.HazardCalculator):
             maxw = self.max_weight
         self.init_poes()
         req_gb, self.trt_rlzs, self.gids = get_pmaps_gb(self.datastore)
+        # lid and gid are stored as uint16 in _rates, see rates_dt
+        assert oq.imtls.size < 2**16, oq.imtls.size
+        assert len(self.trt_rlzs) < 2**16, len(self.trt_rlzs)
         weig = numpy.array([w['weight'] for w in self.full_lt.g_weights(
             self.trt_rlzs)])
         self.datastore['_rates/weig'] = weig
@@ -539,6 +601,9 @@ class ClassicalCalculator(base.HazardCalculator):
                               len(block), sg.weight)
                 allargs.append((block, None, cm, ds))
 
+        # send the heaviest tasks first, so that they do not end up
+        # being the slow tasks at the end of the computation
+        allargs.sort(key=lambda args: args[0].weight, reverse=True)
         self.datastore.swmr_on()  # must come before the Starmap
         smap = parallel.Starmap(classical, allargs, h5=self.datastore.hdf5)
         acc = smap.reduce(self.agg_dicts, acc)
@@ -559,11 +624,10 @@ class ClassicalCalculator(base.HazardCalculator):
         except KeyError:  # if there are no ruptures close to the site
             return
         got = mean_rates_by_src[0].sum(axis=2)  # sum over the sources
-        for m in range(len(got)):
-            # skipping large rates which can be wrong due to numerics
-            # (it happens in logictree/case_05 and in Japan)
-            ok = got[m] < 10.
-            numpy.testing.assert_allclose(got[m, ok], exp[m, ok], atol=1E-5)
+        # skipping large rates which can be wrong due to numerics
+        # (it happens in logictree/case_05 and in Japan)
+        ok = got < 10.
+        numpy.testing.assert_allclose(got[ok], exp[ok], atol=1E-5)
 
     def execute_big(self, maxw):
         """
@@ -573,6 +637,7 @@ class ClassicalCalculator(base.HazardCalculator):
         assert not oq.disagg_by_src
         assert self.N > self.oqparam.max_sites_disagg, self.N
         allargs = []
+        weights = []
         self.ntiles = []
         if '_csm' in self.datastore.parent:
             ds = self.datastore.parent
@@ -585,13 +650,20 @@ class ClassicalCalculator(base.HazardCalculator):
             gid = self.gids[cm.grp_id][0]
             if sg.atomic or sg.weight <= maxw:
                 allargs.append((gid, self.sitecol, cm, ds))
+                weights.append(sg.weight)
             else:
                 tiles = self.sitecol.split(numpy.ceil(sg.weight / maxw))
                 logging.info('Group #%d, %d tiles', cm.grp_id, len(tiles))
                 for tile in tiles:
                     allargs.append((gid, tile, cm, ds))
+                    weights.append(sg.weight / len(tiles))
                     self.ntiles.append(len(tiles))
         logging.warning('Generated at most %d tiles', max(self.ntiles))
+        weights = numpy.array(weights)
+        logging.info('Max/mean task weight = %.1f',
+                     weights.max() / weights.mean())
+        # send the heaviest tasks first, as in execute_reg
+        allargs = [allargs[i] for i in numpy.argsort(-weights, kind='stable')]
         self.datastore.swmr_on()  # must come before the Starmap
         mon = self.monitor('storing rates')
         for dic in parallel.Starmap(classical, allargs, h5=self.datastore.hdf5):
@@ -606,15 +678,17 @@ class ClassicalCalculator(base.HazardCalculator):
         """
         self.store_rlz_info(self.rel_ruptures)
         self.store_source_info(self.source_data)
-        df = pandas.DataFrame(self.source_data)
+        # pass the columns directly, without building a DataFrame
+        columns = [(name, numpy.array(values))
+                   for name, values in self.source_data.items()]
         # NB: the impact factor is the number of effective ruptures;
         # consider for instance a point source producing 200 ruptures
         # for points within the pointsource_distance (n points) and
         # producing 20 effective ruptures for the N-n points outside;
         # then impact = (200 * n + 20 * (N-n)) / N; for n=1 and N=10
         # it gives impact = 38, i.e. there are 38 effective ruptures
-        df['impact'] = df.nsites / self.N
-        self.datastore.create_df('source_data', df)
+        columns.append(('impact', dict(columns)['nsites'] / self.N))
+        self.datastore.create_df('source_data', columns)
         self.source_data.clear()  # save a bit of memory
 
     def collect_hazard(self, acc, pmap_by_kind):
@@ -635,8 +709,8 @@ class ClassicalCalculator(base.HazardCalculator):
                 dset = self.datastore.getitem(kind)
                 array = self.hazard[kind] = numpy.zeros(dset.shape, dset.dtype)
             for r, pmap in enumerate(pmaps):
-                for idx, sid in enumerate(pmap.sids):
-                    array[sid, r] = pmap.array[idx]  # shape (M, P)
+                # the sids are distinct, shape (N', M, P)
+                array[pmap.sids, r] = pmap.array
 
     def post_execute(self, dummy):
         """
@@ -759,24 +833,43 @@ class ClassicalCalculator(base.HazardCalculator):
 
         # generate hazard map plots
         if 'hmaps-stats' in self.datastore and self.N > 1000:
-            hmaps = self.datastore.sel('hmaps-stats', stat='mean')  # NSMP
-            maxhaz = hmaps.max(axis=(0, 1, 3))
-            mh = dict(zip(self.oqparam.imtls, maxhaz))
-            logging.info('The maximum hazard map values are %s', mh)
-            if Image is None or not self.from_engine:  # missing PIL
-                return
-            if self.N < 1000:  # few sites, don't plot
-                return
-            M, P = hmaps.shape[2:]
-            logging.info('Saving %dx%d mean hazard maps', M, P)
-            inv_time = oq.investigation_time
-            allargs = []
-            for m, imt in enumerate(self.oqparam.imtls):
-                for p, poe in enumerate(self.oqparam.poes):
-                    dic = dict(m=m, p=p, imt=imt, poe=poe, inv_time=inv_time,
-                               calc_id=self.datastore.calc_id,
-                               array=hmaps[:, 0, m, p])
-                    allargs.append((dic, self.sitecol.lons, self.sitecol.lats))
-            smap = parallel.Starmap(make_hmap_png, allargs)
-            for dic in smap:
-                self.datastore['png/hmap_%(m)d_%(p)d' % dic] = dic['img']
+            self.plot_hmaps()
+
+    def plot_hmaps(self):
+        """
+        Log the maximum values of the mean hazard maps and store them
+        as images in png/hmap_<m>_<p>
+        """
+        if Image is None or not self.from_engine:  # missing PIL
+            return  # no plots, so do not read the hazard maps
+        oq = self.oqparam
+        hmaps = self.datastore.sel('hmaps-stats', stat='mean')  # NSMP
+        M, P = hmaps.shape[2:]
+        # reduce first on the leading axis, without strided access
+        maxhaz = hmaps.reshape(-1, M, P).max(axis=0).max(axis=1)
+        mh = dict(zip(oq.imtls, maxhaz))
+        logging.info('The maximum hazard map values are %s', mh)
+        logging.info('Saving %dx%d mean hazard maps', M, P)
+        inv_time = oq.investigation_time
+        calc_id = self.datastore.calc_id
+        # the same (contiguous) arrays are passed to all tasks, so that
+        # the Starmap pickles them once and shares them
+        lons = numpy.array(self.sitecol.lons)
+        lats = numpy.array(self.sitecol.lats)
+        # transpose once, so that each task gets a contiguous array
+        hmaps = numpy.ascontiguousarray(hmaps[:, 0].transpose(1, 2, 0))
+        vmins, vmaxs = hmaps.min(axis=2), hmaps.max(axis=2)  # shape MP
+        allargs = []
+        for m, imt in enumerate(oq.imtls):
+            for p, poe in enumerate(oq.poes):
+                # send 256 levels, as many as the colors, as uint8
+                vmin, vmax = vmins[m, p], vmaxs[m, p]
+                dic = dict(m=m, p=p, imt=imt, poe=poe, inv_time=inv_time,
+                           calc_id=calc_id,
+                           array=quantize(hmaps[m, p], vmin, vmax),
+                           vmin=vmin, vmax=vmax)
+                allargs.append((dic, lons, lats))
+        smap = parallel.Starmap(make_hmap_png, allargs)
+        for dic in smap:
+            img = numpy.asarray(Image.open(io.BytesIO(dic['png'])))
+            self.datastore['png/hmap_%(m)d_%(p)d' % dic] = img
@@ -183,6 +183,17 @@ class PmapGetter(object):
     def R(self):
         return len(self.weights)
 
+    @general.cached_property
+    def gr_matrix(self):
+        """
+        :returns: an array of shape (G, R) with the number of times the
+                  rates of the group g contribute to the realization r
+        """
+        arr = numpy.zeros((len(self.trt_rlzs), self.num_rlzs))
+        for g, t_rlzs in enumerate(self.trt_rlzs):
+            numpy.add.at(arr[g], t_rlzs % TWO24, 1)
+        return arr
+
     def init(self):
         """
         Build the probability curves from the underlying dataframes
@@ -194,14 +205,24 @@ class PmapGetter(object):
             for start, stop in self.slices:
                 # reading one slice at the time to save memory in the groupby
                 rates_df = dstore.read_df('_rates', slc=slice(start, stop))
-                for sid, df in rates_df.groupby('sid'):
+                # group by site ID with a stable sort, much faster than
+                # building a DataFrame per site with pandas.groupby
+                sids = rates_df.sid.to_numpy()
+                order = numpy.argsort(sids, kind='stable')
+                sids = sids[order]
+                lids = rates_df.lid.to_numpy()[order]
+                gids = rates_df.gid.to_numpy()[order]
+                rates = rates_df.rate.to_numpy()[order]
+                usids, starts = numpy.unique(sids, return_index=True)
+                stops = numpy.append(starts[1:], len(sids))
+                for sid, i0, i1 in zip(usids, starts, stops):
                     try:
                         array = self._pmap[sid].array
                     except KeyError:
                         array = numpy.zeros((self.L, G))
                         self._pmap[sid] = probability_map.ProbabilityCurve(
                             array)
-                    array[df.lid, df.gid] = df.rate
+                    array[lids[i0:i1], gids[i0:i1]] = rates[i0:i1]
         return self._pmap
 
     # used in risk calculations where there is a single site per getter
@@ -224,17 +245,12 @@ class PmapGetter(object):
         :returns: a ProbabilityCurve of shape L, R for the given site ID
         """
         pmap = self.init()
-        pc0 = probability_map.ProbabilityCurve(
-            numpy.zeros((self.L, self.num_rlzs)))
         if sid not in pmap:  # no hazard for sid
-            return pc0
-        for g, t_rlzs in enumerate(self.trt_rlzs):
-            rlzs = t_rlzs % TWO24
-            rates = pmap[sid].array[:, g]
-            for rlz in rlzs:
-                pc0.array[:, rlz] += rates
-        pc0.array = to_probs(pc0.array)
-        return pc0
+            return probability_map.ProbabilityCurve(
+                numpy.zeros((self.L, self.num_rlzs)))
+        # sum the rates of the groups contributing to each realization
+        rates = pmap[sid].array @ self.gr_matrix  # shape (L, R)
+        return probability_map.ProbabilityCurve(to_probs(rates))
 
     def get_mean(self):
         """
@@ -395,7 +395,14 @@ def view_job_info(token, dstore):
     """
     data = []
     task_info = dstore['task_info'][()]
-    task_sent = ast.literal_eval(decode(dstore['task_sent'][()]))
+    sent_arr = dstore['task_sent'][()]
+    if numpy.ndim(sent_arr) == 0:  # old datastore with a dict string
+        task_sent = ast.literal_eval(decode(sent_arr))
+    else:
+        task_sent = AccumDict(accum=AccumDict())  # task -> arg -> nbytes
+        for rec in sent_arr:
+            task_sent[decode(rec['taskname'])] += {
+                decode(rec['argname']): rec['nbytes']}
     for task, dic in task_sent.items():
         sent = sorted(dic.items(), key=operator.itemgetter(1), reverse=True)
         sent = ['%s=%s' % (k, humansize(v)) for k, v in sent[:3]]
@@ -24,14 +24,13 @@ extracting a specific PMF from the result of :func:`disaggregation`.
 
 import operator
 import collections
-import itertools
 from unittest.mock import Mock
 from functools import lru_cache
 import numpy
 import scipy.stats
 
 from openquake.baselib.general import AccumDict, groupby, humansize
-from openquake.baselib.performance import idx_start_stop, Monitor
+from openquake.baselib.performance import idx_start_stop, Monitor, compile
 from openquake.baselib.python3compat import decode
 from openquake.hazardlib.imt import from_string
 from openquake.hazardlib.calc import filters
@@ -190,9 +189,10 @@ def get_eps4(eps_edges, truncation_level):
 
 
 # NB: this function is the crucial bit for performance!
-def _disaggregate(ctx, mea, std, cmaker, g, iml2, bin_edges, epsstar, gp,
-                  infer_occur_rates, mon1, mon2, mon3):
+def _disaggregate(ctx, bdata, mea, std, cmaker, g, iml2, bin_edges, epsstar,
+                  gp, infer_occur_rates, mon1, mon2, mon3):
     # ctx: a recarray of size U for a single site and magnitude bin
+    # bdata: a BinData with contiguous arrays of size U and pnes=None
     # mea: array of shape (G, M, U)
     # std: array of shape (G, M, U)
     # cmaker: a ContextMaker instance
@@ -208,9 +208,21 @@ def _disaggregate(ctx, mea, std, cmaker, g, iml2, bin_edges, epsstar, gp,
         eps_edges = tuple(bin_edges[-1])  # last edge
         min_eps, max_eps, eps_bands, cum_bands = get_eps4(
             eps_edges, cmaker.truncation_level)
-        U, E = len(ctx), len(eps_bands)
         M, P = iml2.shape
         phi_b = cmaker.phi_b
+        slow = not infer_occur_rates and any(
+            len(po) for po in ctx.probs_occur)
+        if not slow:
+            # discard the ruptures with all the epsilons above the truncation
+            # level and the last eps edge: they have zero poes, i.e. pnes=1,
+            # so they cannot contribute to the disaggregation matrix
+            ok = _contributing(mea[g], std[g], iml2,
+                               max(cmaker.truncation_level, max_eps))
+            if not ok.all():
+                ctx = ctx[ok]
+                bdata = BinData(*[arr[ok] for arr in bdata[:3]], None)
+                mea, std = mea[:, :, ok], std[:, :, ok]
+        U, E = len(ctx), len(eps_bands)
         # U - Number of contexts (i.e. ruptures if there is a single site)
         # E - Number of epsilons
         # M - Number of IMTs
@@ -238,30 +250,47 @@ def _disaggregate(ctx, mea, std, cmaker, g, iml2, bin_edges, epsstar, gp,
 
     with mon2:
         time_span = cmaker.investigation_time
-        if not infer_occur_rates and any(len(po) for po in ctx.probs_occur):
+        if slow:
             # slow lane, case_65
             for u, rec in enumerate(ctx):
                 pnes[u] *= get_pnes(rec.occurrence_rate, rec.probs_occur,
                                     poes[u], time_span)
         else:
-            # poissonian, fast lane
-            for e, m, p in itertools.product(range(E), range(M), range(P)):
-                pnes[:, e, m, p] *= numpy.exp(
-                    -ctx.occurrence_rate * poes[:, e, m, p] * time_span)
+            # poissonian, fast lane, vectorized on all ruptures and bins
+            rates = ctx.occurrence_rate[:, None, None, None]
+            pnes *= numpy.exp(-rates * poes * time_span)
 
     with mon3:
-        bindata = BinData(ctx.rrup, ctx.clon, ctx.clat, pnes)
-        return _build_disagg_matrix(bindata, bin_edges[1:])
+        return _build_disagg_matrix(bdata._replace(pnes=pnes), bin_edges[1:])
 
 
+def _contributing(mea, std, iml2, max_lvl):
+    # mea: array of shape (M, U)
+    # std: array of shape (M, U)
+    # iml2: an array of shape (M, P) of logarithmic intensities
+    # returns a boolean array of size U, False for the ruptures which
+    # cannot exceed any level (NaNs are kept, as in _disaggregate)
+    ok = numpy.zeros(mea.shape[1], bool)
+    for (m, p), iml in numpy.ndenumerate(iml2):
+        if iml != -numpy.inf:
+            ok |= ~((iml - mea[m]) / std[m] > max_lvl)
+    return ok
+
+
+@compile("float64[:, :](float64[:], int64[:], float64[:], float64[:])")
 def _disagg_eps(survival, bins, eps_bands, cum_bands):
     # disaggregate PoE of `iml` in different contributions,
-    # each coming from ``epsilons`` distribution bins
-    res = numpy.zeros((len(bins), len(eps_bands)))
-    for e, eps_band in enumerate(eps_bands):
-        res[bins <= e, e] = eps_band  # left bins
-        inside = bins == e + 1  # inside bins
-        res[inside, e] = survival[inside] - cum_bands[bins[inside]]
+    # each coming from ``epsilons`` distribution bins;
+    # single pass on the ruptures, without allocating E boolean masks
+    U, E = len(bins), len(eps_bands)
+    res = numpy.zeros((U, E))
+    for u in range(U):
+        b = bins[u]
+        for e in range(E):
+            if b <= e:  # left bins
+                res[u, e] = eps_bands[e]
+            elif b == e + 1:  # inside bin
+                res[u, e] = survival[u] - cum_bands[b]
     return res  # shape (U, E)
 
 
@@ -295,9 +324,18 @@ def _build_disagg_matrix(bdata, bins):
     lats_idx[lats_idx == dim3] = dim3 - 1
     U, E, M, P = bdata.pnes.shape
     mat6D = numpy.ones(shape + [M, P])
-    for i_dist, i_lon, i_lat, pne in zip(
-            dists_idx, lons_idx, lats_idx, bdata.pnes):
-        mat6D[i_dist, i_lon, i_lat] *= pne  # shape E, M, P
+    if U == 0:
+        return 1. - mat6D
+
+    # multiply the pnes of the ruptures falling in the same (dist, lon, lat)
+    # bin with a single reduceat instead of a Python loop on the ruptures;
+    # mode='wrap' keeps the semantics of negative indices (i.e. -1 -> last)
+    idxs = numpy.ravel_multi_index(
+        (dists_idx, lons_idx, lats_idx), shape[:3], mode='wrap')
+    order = numpy.argsort(idxs, kind='stable')
+    uidxs, start = numpy.unique(idxs[order], return_index=True)
+    mat3D = mat6D.reshape(-1, E, M, P)
+    mat3D[uidxs] = numpy.multiply.reduceat(bdata.pnes[order], start, axis=0)
     return 1. - mat6D
 
 
@@ -342,6 +380,18 @@ def _digitize_lons(lons, lon_bins):
 
 # ########################## Disaggregator class ########################## #
 
+def get_imlog2(imldic):
+    """
+    :param imldic: a dictionary imt -> imls
+    :returns: an array of shape (M, P) of logarithmic intensities
+    """
+    iml2 = numpy.array(list(imldic.values()))  # shape (M, P)
+    imlog2 = numpy.zeros_like(iml2)
+    for m, imt in enumerate(imldic):
+        imlog2[m] = to_distribution_values(iml2[m], imt)
+    return imlog2
+
+
 def split_by_magbin(ctxt, mag_edges):
     """
     :param ctxt: a context array
@@ -387,6 +437,8 @@ class Disaggregator(object):
             setattr(self, name, len(self.bin_edges[i]) - 1)
         self.dist_idx = {}  # magi -> dist_idx
         self.mea, self.std = {}, {}  # magi -> array[G, M, U]
+        # (magi, mutex) -> (ctx, bdata, mea, std), computed once by .init
+        self.magidata = {}
 
         self.g_by_rlz = {}  # dict rlz -> g
         for g, rlzs in enumerate(cmaker.gsims.values()):
@@ -418,8 +470,27 @@ class Disaggregator(object):
         if not hasattr(self, 'ctx_by_magi'):
             # the first time build the magnitude bins
             self.ctx_by_magi = split_by_magbin(self.fullctx, self.bin_edges[0])
+        key = magi, bool(src_mutex)
+        if key not in self.magidata:
+            self.magidata[key] = self._init_magi(magi, mon0)
+        # the contexts and mean_stds are computed only the first time
+        self.ctx, self.bdata, self.mea[magi], self.std[magi] = (
+            self.magidata[key])
+        self.dist_idx[magi] = numpy.digitize(
+            self.bdata.dists, self.bin_edges[1]) - 1
+        if self.src_mutex:
+            mat = idx_start_stop(self.ctx.src_id)  # shape (n, 3)
+            src_ids = mat[:, 0]  # subset contributing to the given magi
+            self.src_mutex['start'] = mat[:, 1]
+            self.src_mutex['stop'] = mat[:, 2]
+            self.weights = [w for s, w in zip(self.src_mutex['src_id'],
+                                              self.src_mutex['weight'])
+                            if s in src_ids]
+
+    def _init_magi(self, magi, mon0):
+        # returns ctx, bdata, mea, std for the given magnitude bin
         try:
-            self.ctx = self.ctx_by_magi[magi]
+            ctx = self.ctx_by_magi[magi]
         except KeyError:
             raise FarAwayRupture
         if self.src_mutex:
@@ -427,37 +498,29 @@ class Disaggregator(object):
             # the src_id is set in contexts.py to be equal to the fragmentno
             # NB: using ctx.sort(order='src_id') would cause a ValueError
             # NB: argsort can be problematic on AVX-512 processors!
-            self.ctx = self.ctx[numpy.argsort(self.ctx.src_id)]
-        self.dist_idx[magi] = numpy.digitize(
-            self.ctx.rrup, self.bin_edges[1]) - 1
+            ctx = ctx[numpy.argsort(ctx.src_id)]
+        # extract the binning fields as contiguous arrays (SoA), since the
+        # fields of the context recarray are strided views
+        bdata = BinData(numpy.ascontiguousarray(ctx.rrup),
+                        numpy.ascontiguousarray(ctx.clon),
+                        numpy.ascontiguousarray(ctx.clat),
+                        None)
         with mon0:
             # shape (G, M, U), where M = len(imts) <= len(imtls)
-            self.mea[magi], self.std[magi] = self.cmaker.get_mean_stds(
-                [self.ctx])[:2]
-        if self.src_mutex:
-            mat = idx_start_stop(self.ctx.src_id)  # shape (n, 3)
-            src_ids = mat[:, 0]  # subset contributing to the given magi
-            self.src_mutex['start'] = mat[:, 1]
-            self.src_mutex['stop'] = mat[:, 2]
-            self.weights = [w for s, w in zip(self.src_mutex['src_id'],
-                                              self.src_mutex['weight'])
-                            if s in src_ids]
+            mea, std = self.cmaker.get_mean_stds([ctx])[:2]
+        return ctx, bdata, mea, std
 
-    def _disagg6D(self, imldic, g):
+    def _disagg6D(self, imlog2, g):
         # returns a 6D matrix of shape (D, Lo, La, E, M, P)
-        # compute the logarithmic intensities
+        # imlog2 is the (M, P) array of logarithmic intensities
         # returns poes for src_mutex and rates otherwise
-        imts = list(imldic)
-        iml2 = numpy.array(list(imldic.values()))  # shape (M, P)
-        imlog2 = numpy.zeros_like(iml2)
-        for m, imt in enumerate(imts):
-            imlog2[m] = to_distribution_values(iml2[m], imt)
         mea, std = self.mea[self.magi], self.std[self.magi]
         gp = self.src_mutex.get('grp_probability', 1.)
+        infer_occur_rates = self.cmaker.oq.infer_occur_rates
         if not self.src_mutex:
-            poes = _disaggregate(self.ctx, mea, std, self.cmaker,
+            poes = _disaggregate(self.ctx, self.bdata, mea, std, self.cmaker,
                                  g, imlog2, self.bin_edges, self.epsstar, gp,
-                                 self.cmaker.oq.infer_occur_rates,
+                                 infer_occur_rates,
                                  self.mon1, self.mon2, self.mon3)
             return to_rates(poes)
 
@@ -465,11 +528,12 @@ class Disaggregator(object):
         mats = []
         for s1, s2 in zip(self.src_mutex['start'], self.src_mutex['stop']):
             ctx = self.ctx[s1:s2]
+            bdata = BinData(*[arr[s1:s2] for arr in self.bdata[:3]], None)
             mea = self.mea[self.magi][:, :, s1:s2]  # shape (G, M, U)
             std = self.std[self.magi][:, :, s1:s2]  # shape (G, M, U)
-            mat = _disaggregate(ctx, mea, std, self.cmaker, g, imlog2,
+            mat = _disaggregate(ctx, bdata, mea, std, self.cmaker, g, imlog2,
                                 self.bin_edges, self.epsstar, gp,
-                                self.cmaker.oq.infer_occur_rates,
+                                infer_occur_rates,
                                 self.mon1, self.mon2, self.mon3)
             mats.append(mat)
         poes = numpy.einsum('i,i...', self.weights, mats)
@@ -489,6 +553,7 @@ class Disaggregator(object):
         :yields:
             a dictionary with keys trti, magi, sid, rlzi, mean for each magi
         """
+        imlog2 = get_imlog2(imtls)  # the same for all magnitude bins
         for magi in range(self.Ma):
             try:
                 self.init(magi, src_mutex, mon0, mon1, mon2, mon3)
@@ -499,12 +564,15 @@ class Disaggregator(object):
             else:
                 mw = 1.
             res = {'trti': self.cmaker.trti, 'magi': self.magi, 'sid': self.sid}
+            arr6D_by_g = {}  # realizations with the same gsim share the matrix
             for rlz in rlzs:
                 try:
                     g = self.g_by_rlz[rlz]
                 except KeyError:  # non-contributing rlz
                     continue
-                arr6D = self._disagg6D(imtls, g)
+                if g not in arr6D_by_g:
+                    arr6D_by_g[g] = self._disagg6D(imlog2, g)
+                arr6D = arr6D_by_g[g]
                 res[rlz] = to_rates(arr6D) if src_mutex else arr6D
                 if rwdic:  # compute mean rates (mean poes for src_mutex)
                     if 'mean' not in res:
@@ -523,7 +591,7 @@ class Disaggregator(object):
         :returns: a 4D matrix of rates of shape (Ma, D, E, M)
         """
         M = len(imldic)
-        imtls = {imt: [iml] for imt, iml in imldic.items()}
+        imlog2 = get_imlog2({imt: [iml] for imt, iml in imldic.items()})
         out = numpy.zeros((self.Ma, self.D, self.E, M))  # rates
         for magi in range(self.Ma):
             try:
@@ -534,10 +602,13 @@ class Disaggregator(object):
                 mw = sum(self.weights)
             else:
                 mw = 1.
+            mat4_by_g = {}  # realizations with the same gsim share the matrix
             for rlz, g in self.g_by_rlz.items():
-                mat5 = self._disagg6D(imtls, g)[..., 0]  # p = 0
-                # summing on lon, lat and producing a (D, E, M) array
-                out[magi] += mat5.sum(axis=(1, 2)) * rlz_weights[rlz] * mw
+                if g not in mat4_by_g:
+                    mat5 = self._disagg6D(imlog2, g)[..., 0]  # p = 0
+                    # summing on lon, lat and producing a (D, E, M) array
+                    mat4_by_g[g] = mat5.sum(axis=(1, 2))
+                out[magi] += mat4_by_g[g] * rlz_weights[rlz] * mw
         return to_rates(out) if src_mutex else out
 
     def __repr__(self):
@@ -630,7 +701,7 @@ def disaggregation(
     ctxs = AccumDict(accum=[])
     cmaker = {}  # trt -> cmaker
     mags_by_trt = AccumDict(accum=set())
-    dists = []
+    maxdist = 0.
     tom = sources[0].temporal_occurrence_model
     oq = Mock(imtls={str(imt): [iml]},
               poes=[None],
@@ -649,11 +720,12 @@ def disaggregation(
         cmaker[trt] = cm = ContextMaker(trt, rlzs_by_gsim, oq)
         ctxs[trt].extend(cm.from_srcs(srcs, sitecol))
         for ctx in ctxs[trt]:
-            mags_by_trt[trt] |= set(ctx.mag)
-            dists.extend(ctx.rrup)
+            mags_by_trt[trt] |= set(numpy.unique(ctx.mag))
+            if len(ctx):
+                maxdist = max(maxdist, ctx.rrup.max())
 
     if source_filter is filters.nofilter:
-        oq.maximum_distance = filters.IntegrationDistance.new(str(max(dists)))
+        oq.maximum_distance = filters.IntegrationDistance.new(str(maxdist))
 
     # Build bin edges
     bin_edges, dic = get_edges_shapedic(oq, sitecol)
@@ -661,6 +733,7 @@ def disaggregation(
     # Compute disaggregation per TRT
     matrix = numpy.zeros([dic['mag'], dic['dist'], dic['lon'], dic['lat'],
                           dic['eps'], len(trts)])
+    imlog2 = get_imlog2({imt: [iml]})
     for trt in cmaker:
         dis = Disaggregator(ctxs[trt], sitecol, cmaker[trt], bin_edges)
         for magi in range(dis.Ma):
@@ -668,7 +741,7 @@ def disaggregation(
                 dis.init(magi, src_mutex={})  # src_mutex not implemented yet
             except FarAwayRupture:
                 continue
-            mat4 = dis._disagg6D({imt: [iml]}, 0)[..., 0, 0]
+            mat4 = dis._disagg6D(imlog2, 0)[..., 0, 0]
             matrix[magi, ..., trt_num[trt]] = mat4
     return bin_edges, to_probs(matrix)
 
@@ -716,10 +789,11 @@ def get_ints(src_ids):
     """
     :returns: array of integers from source IDs following the colon convention
     """
-    out = []
-    for src_id in decode(list(src_ids)):
-        out.append(int(src_id.split(':')[1]))
-    return numpy.uint32(out)
+    src_ids = decode(list(src_ids))
+    out = numpy.empty(len(src_ids), numpy.uint32)
+    for i, src_id in enumerate(src_ids):
+        out[i] = int(src_id.split(':')[1])
+    return out
 
 
 def disagg_source(groups, site, reduced_lt, edges_shapedic,
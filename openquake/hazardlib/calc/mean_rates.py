@@ -26,17 +26,22 @@ from openquake.hazardlib.contexts import get_cmakers
 CUTOFF = 1E-12
 
 
-def to_rates(probs, itime=1, minrate=0.):
+def to_rates(probs, itime=1, minrate=0., out=None):
     """
     Convert an array of probabilities into an array of rates
 
+    :param out: if given, an array of the same shape to be used as buffer
+
     >>> numpy.round(to_rates(numpy.array([.8])), 6)
     array([1.609438])
     """
-    pnes = 1. - probs
-    pnes[pnes == 0] = 1E-45  # minimum 32 bit float
+    # NB: all the operations are performed in place on a single buffer
+    rates = numpy.subtract(1., probs, out=out)
+    rates[rates == 0] = 1E-45  # minimum 32 bit float
     # NB: the test most sensitive to 1E-45 and 1E-12 is case_78
-    rates = - numpy.log(pnes) / itime
+    numpy.log(rates, out=rates)
+    numpy.negative(rates, out=rates)
+    rates /= itime
     rates[rates < CUTOFF] = minrate
     rates[rates > 100.] = 100.
     return rates
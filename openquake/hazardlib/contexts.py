@@ -541,12 +541,16 @@ def genctxs_Pp(src, sitecol, cmaker):
 
 def _build_dparam(src, sitecol, cmaker):
     dparams = {'rjb', 'tuw'}
-    if cmaker.fewsites:
-        dparams |= {'clon_clat'}
     sections = src.get_sections(src.get_unique_idxs())
     out = {}
     for sec in sections:
-        out[sec.idx, 'rrup'] = get_dparam(sec, sitecol, 'rrup')
+        if cmaker.fewsites:
+            # rrup and clon_clat share the same distance matrix
+            rrup, cps = sec.get_min_distance_closest_points(sitecol)
+            out[sec.idx, 'rrup'] = rrup
+            out[sec.idx, 'clon_clat'] = cps.array.T[:, 0:2]
+        else:
+            out[sec.idx, 'rrup'] = get_dparam(sec, sitecol, 'rrup')
         for param in dparams:
             out[sec.idx, param] = get_dparam(sec, sitecol, param)
     # use multi_fault_test to debug this
@@ -1193,7 +1197,7 @@ class ContextMaker(object):
         :returns: an array of annual rates of shape (N, L, G)
         """
         pmap = self.get_pmap(self.from_srcs(srcgroup, sitecol))
-        return (~pmap).to_rates()
+        return pmap.poes_to_rates()
 
     def update(self, pmap, ctxs, tom, rup_mutex={}):
         """
@@ -368,6 +368,25 @@ class Mesh(object):
         deps = self.depths.take(min_idx)
         return Mesh(lons, lats, deps)
 
+    def get_min_distance_closest_points(self, mesh):
+        """
+        Compute the minimum distances and the closest points at the same
+        time, by building the distance matrix only once.
+
+        :returns:
+            a pair (distances, closest points), equivalent to the results
+            of .get_min_distance(mesh) and .get_closest_points(mesh)
+        """
+        dists = cdist(self.xyz, mesh.xyz)
+        min_idx = dists.argmin(axis=0)
+        min_dist = dists[min_idx, numpy.arange(len(min_idx))]
+        if hasattr(mesh, 'shape'):
+            min_idx = min_idx.reshape(mesh.shape)
+        lons = self.lons.take(min_idx)
+        lats = self.lats.take(min_idx)
+        deps = self.depths.take(min_idx)
+        return min_dist, Mesh(lons, lats, deps)
+
     def get_distance_matrix(self):
         """
         Compute and return distances between each pairs of points in the mesh.
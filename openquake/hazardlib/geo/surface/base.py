@@ -173,6 +173,20 @@ class BaseSurface:
         fmesh = _get_finite_mesh(self.mesh)
         return fmesh.get_closest_points(mesh)
 
+    def get_min_distance_closest_points(self, mesh):
+        """
+        Compute at the same time the minimum distance from the surface and
+        the closest surface point for each point of ``mesh``.
+
+        :param mesh:
+            :class:`~openquake.hazardlib.geo.mesh.Mesh` of points
+        :returns:
+            A pair (distances, closest points), as returned by
+            :meth:`get_min_distance` and :meth:`get_closest_points`
+        """
+        fmesh = _get_finite_mesh(self.mesh)
+        return fmesh.get_min_distance_closest_points(mesh)
+
     def get_joyner_boore_distance(self, mesh):
         """
         Compute and return Joyner-Boore (also known as ``Rjb``) distance
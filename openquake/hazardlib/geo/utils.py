@@ -204,32 +204,34 @@ class _GeographicObjects(object):
         :returns: filtered site collection, filtered objects, discarded
         """
         assert mode in 'strict warn filter', mode
-        dic = {}
-        discarded = []
-        for sid, lon, lat in zip(sitecol.sids, sitecol.lons, sitecol.lats):
-            obj, distance = self.get_closest(lon, lat)
-            if assoc_dist is None:
-                dic[sid] = obj  # associate all
-            elif distance <= assoc_dist:
-                dic[sid] = obj  # associate within
-            elif mode == 'warn':
-                dic[sid] = obj  # associate outside
-                logging.warning(
-                    'The closest vs30 site (%.1f %.1f) is distant more than %d'
-                    ' km from site #%d (%.1f %.1f)', obj['lon'], obj['lat'],
-                    int(distance), sid, lon, lat)
-            elif mode == 'filter':
-                discarded.append(obj)
-            elif mode == 'strict':
+        # find the closest objects to all the sites with a single query
+        objs, distances = self.get_closest(sitecol.lons, sitecol.lats)
+        if assoc_dist is None:
+            ok = numpy.ones(len(sitecol), bool)  # associate all
+        else:
+            ok = distances <= assoc_dist  # associate within
+            outside, = numpy.where(~ok)
+            if len(outside) and mode == 'strict':
+                o = outside[0]
                 raise SiteAssociationError(
                     'There is nothing closer than %s km '
-                    'to site (%s %s)' % (assoc_dist, lon, lat))
-        if not dic:
+                    'to site (%s %s)' % (assoc_dist, sitecol.lons[o],
+                                         sitecol.lats[o]))
+            elif mode == 'warn':
+                for o in outside:
+                    logging.warning(
+                        'The closest vs30 site (%.1f %.1f) is distant more '
+                        'than %d km from site #%d (%.1f %.1f)',
+                        objs[o]['lon'], objs[o]['lat'], int(distances[o]),
+                        sitecol.sids[o], sitecol.lons[o], sitecol.lats[o])
+                ok[:] = True  # associate outside
+        discarded = list(objs[~ok])  # nonempty only in filter mode
+        if not ok.any():
             raise SiteAssociationError(
                 'No sites could be associated within %s km' % assoc_dist)
-        sids = sorted(dic)
-        return (sitecol.filtered(sids), numpy.array([dic[s] for s in sids]),
-                discarded)
+        sids = sitecol.sids[ok]
+        order = numpy.argsort(sids)
+        return sitecol.filtered(sids[order]), objs[ok][order], discarded
 
     def assoc2(self, exp, assoc_dist, region, mode):
         """
@@ -246,13 +248,10 @@ class _GeographicObjects(object):
         mesh = exp.mesh
         assets_by_site = split_array(exp.assets, exp.assets['site_id'])
         if region:
-            # TODO: use SRTree
-            out = []
-            for i, (lon, lat) in enumerate(zip(mesh.lons, mesh.lats)):
-                if not geometry.Point(lon, lat).within(region):
-                    out.append(i)
-            if out:
-                ok = ~numpy.isin(numpy.arange(len(mesh)), out)
+            # boolean mask of the sites inside the region
+            ok = contains_xy(region, mesh.lons, mesh.lats)
+            nout = len(ok) - ok.sum()
+            if nout:
                 if ok.sum() == 0:
                     raise RuntimeError(
                         'Could not find any asset within the region!')
@@ -260,7 +259,7 @@ class _GeographicObjects(object):
                 assets_by_site = [
                     assets for yes, assets in zip(ok, assets_by_site) if yes]
                 logging.info('Discarded %d assets outside the region',
-                             len(out))
+                             nout)
         asset_dt = numpy.dtype(
             [('asset_ref', vstr), ('lon', F32), ('lat', F32)])
         assets_by_sid = collections.defaultdict(list)
@@ -295,6 +295,61 @@ if numba:
     update_pmap_m = compile(sig)(update_pmap_m)
 
 
+@compile("float32(float64, float32)")
+def _rate(poe, itime):
+    # the rate -log(1 - poe) / itime in single precision, as in .to_rates
+    if poe == 1.:  # see the comment in .to_rates
+        return F32(-math.log(1.11E-16)) / itime
+    return F32(-math.log1p(-poe)) / itime
+
+
+@compile("Tuple((uint32[:], uint16[:], uint16[:], float32[:]))"
+         "(float64[:, :, :], float32)")
+def _nonzero_rates(poes, itime):
+    # returns the indices and the rates -log(1 - poes) / itime for the
+    # nonzero rates (tiny PoEs give zero rates in single precision), in the
+    # same order as flatnonzero, without allocating a full array
+    N, L, G = poes.shape
+    n = 0
+    for i in range(N):
+        for li in range(L):
+            for g in range(G):
+                poe = poes[i, li, g]
+                if poe != 0. and _rate(poe, itime) != 0.:
+                    n += 1
+    idxs = numpy.empty(n, U32)
+    lids = numpy.empty(n, U16)
+    gids = numpy.empty(n, U16)
+    rates = numpy.empty(n, F32)
+    k = 0
+    for i in range(N):
+        for li in range(L):
+            for g in range(G):
+                poe = poes[i, li, g]
+                if poe == 0.:
+                    continue
+                rate = _rate(poe, itime)
+                if rate != 0.:
+                    idxs[k] = i
+                    lids[k] = li
+                    gids[k] = g
+                    rates[k] = rate
+                    k += 1
+    return idxs, lids, gids, rates
+
+
+@compile("void(float32[:, :, :], uint32[:], float32[:, :, :], int64[:])")
+def _add_rates(rates, idxs, array, gids):
+    # rates[idxs[n], :, gids[i]] += array[n, :, i % G], looping on the
+    # gids in the inner loop to follow the memory layout
+    N, L, G = array.shape
+    for n in range(N):
+        idx = idxs[n]
+        for li in range(L):
+            for i in range(len(gids)):
+                rates[idx, li, gids[i]] += array[n, li, i % G]
+
+
 def fix_probs_occur(probs_occur):
     """
     Try to convert object arrays into regular arrays
@@ -407,17 +462,55 @@ class ProbabilityMap(object):
         rates = -numpy.log(pnes).astype(F32)
         return self.new(rates / itime)
 
+    def poes_to_rates(self, itime=1.):
+        """
+        Assuming self contains an array of PoEs, returns the same as
+        (~self).to_rates(itime) in a single pass, computing -log1p(-poes)
+        """
+        rates = numpy.negative(self.array)
+        with numpy.errstate(divide='ignore'):
+            numpy.log1p(rates, out=rates)
+        rates[rates == -numpy.inf] = math.log(1.11E-16)  # PoE 1
+        return self.new(-rates.astype(F32) / itime)
+
+    def add_rates(self, pmap, gids):
+        """
+        Assuming self and pmap contain rates, add the G columns of pmap
+        to the columns `gids` of self, for the sites of pmap
+        """
+        idxs = self.sidx[pmap.sids]
+        if numba and self.array.dtype == pmap.array.dtype == F32:
+            _add_rates(self.array, idxs, pmap.array, numpy.int64(gids))
+        else:
+            G = pmap.array.shape[2]
+            for i, gid in enumerate(gids):
+                self.array[idxs, :, gid] += pmap.array[:, :, i % G]
+
     def to_dict(self, gid=0):
         """
         Assuming self contains an array of rates,
         returns a dictionary of arrays with keys sid, lid, gid, rate
         """
-        rates = self.array
-        idxs, lids, gids = rates.nonzero()
+        # a single pass on the flat array, without 3D fancy indexing
+        flat = self.array.reshape(-1)
+        nz = numpy.flatnonzero(flat)
+        idxs, lids, gids = numpy.unravel_index(nz, self.array.shape)
         out = dict(sid=U32(self.sids[idxs]), lid=U16(lids),
-                   gid=U16(gids + gid), rate=F32(rates[idxs, lids, gids]))
+                   gid=U16(gids + gid), rate=F32(flat[nz]))
         return out
 
+    def to_rates_dict(self, gid=0, itime=1.):
+        """
+        Assuming self contains an array of PoEs, returns the same
+        dictionary as .poes_to_rates(itime).to_dict(gid), without building
+        the intermediate array of rates if numba is available
+        """
+        if numba is None or self.array.dtype != F64:
+            return self.poes_to_rates(itime).to_dict(gid)
+        idxs, lids, gids, rates = _nonzero_rates(self.array, F32(itime))
+        return dict(sid=U32(self.sids[idxs]), lid=lids,
+                    gid=U16(gids + gid), rate=rates)
+
     def interp4D(self, imtls, poes):
         """
         :param imtls: a dictionary imt->imls with M items
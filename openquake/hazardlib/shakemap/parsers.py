@@ -308,8 +308,8 @@ def _get_shakemap_array(xml_file):
         data = open(xml_file)
     grid_node = node_from_xml(data)
     fields = grid_node.getnodes('grid_field')
-    lines = grid_node.grid_data.text.strip().splitlines()
-    rows = [line.split() for line in lines]
+    # parse the whole grid in a single call, one row per line
+    rows = numpy.loadtxt(io.StringIO(grid_node.grid_data.text), ndmin=2)
 
     # the indices start from 1, hence the -1 below
     idx = {f['name']: int(f['index']) - 1 for f in fields
@@ -322,7 +322,7 @@ def _get_shakemap_array(xml_file):
     for name in idx:
         i = idx[name]
         if name in FIELDMAP:
-            out[name].append([float(row[i]) for row in rows])
+            out[name] = rows[:, i]
     dt = sorted((imt[1], F32) for key, imt in FIELDMAP.items()
                 if imt[0] == 'val')
     dtlist = [('lon', F32), ('lat', F32), ('vs30', F32),
@@ -84,6 +84,40 @@ class DigitizeLonsTestCase(unittest.TestCase):
         numpy.testing.assert_equal(idx, expected)
 
 
+class BuildDisaggMatrixTestCase(unittest.TestCase):
+
+    def test_same_as_loop(self):
+        rng = numpy.random.default_rng(42)
+        U, E, M, P = 50, 3, 2, 1
+        bins = [numpy.arange(0., 60., 10.),  # dist
+                numpy.array([-0.5, 0., 0.5]),  # lon
+                numpy.array([-0.5, 0., 0.5]),  # lat
+                numpy.array([-3., -1., 1., 3.])]  # eps
+        bdata = disagg.BinData(rng.uniform(0, 50, U),
+                               rng.uniform(-0.5, 0.5, U),
+                               rng.uniform(-0.5, 0.5, U),
+                               rng.uniform(0.9, 1., (U, E, M, P)))
+        mat = disagg._build_disagg_matrix(bdata, bins)
+        self.assertEqual(mat.shape, (5, 2, 2, E, M, P))
+
+        # compare with the naive loop on the ruptures
+        exp = numpy.ones(mat.shape)
+        d_idx = numpy.digitize(bdata.dists, bins[0]) - 1
+        lo_idx = numpy.digitize(bdata.lons, bins[1]) - 1
+        la_idx = numpy.digitize(bdata.lats, bins[2]) - 1
+        for d, lo, la, pne in zip(d_idx, lo_idx, la_idx, bdata.pnes):
+            exp[d, lo, la] *= pne
+        aac(mat, 1. - exp)
+
+    def test_contributing(self):
+        mea = numpy.log([[.01, .1, 1., .02]])  # shape (M, U) = (1, 4)
+        std = numpy.array([[.5, .5, .5, numpy.nan]])
+        iml2 = numpy.log([[.2, .3]])  # shape (M, P) = (1, 2)
+        ok = disagg._contributing(mea, std, iml2, 3.)
+        # the first rupture is far away, the last one is kept since NaN
+        numpy.testing.assert_equal(ok, [False, True, True, True])
+
+
 class DisaggregateTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -0,0 +1,65 @@
+# The Hazard Library
+# Copyright (C) 2023 GEM Foundation
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+import numpy
+from openquake.hazardlib.probability_map import ProbabilityMap
+
+F32 = numpy.float32
+F64 = numpy.float64
+
+
+class ProbabilityMapTestCase(unittest.TestCase):
+    # the numba kernels must give the same results as the numpy code
+
+    def setUp(self):
+        self.rng = numpy.random.default_rng(42)
+        self.sids = numpy.array([3, 7, 8, 20, 41], numpy.uint32)
+
+    def test_to_rates_dict(self):
+        poes = self.rng.random((5, 4, 3))
+        poes[poes < .3] = 0.  # zeros are discarded
+        poes[0, 0, :] = 1.  # PoEs 1 are replaced
+        poes[1, 0, :] = 1E-50  # zero rates in single precision
+        pmap = ProbabilityMap(self.sids, 4, 3).new(poes)
+        got = pmap.to_rates_dict(gid=5, itime=2.)
+        exp = pmap.poes_to_rates(2.).to_dict(5)
+        self.assertEqual(list(got), list(exp))
+        for key in ('sid', 'lid', 'gid'):
+            self.assertEqual(got[key].dtype, exp[key].dtype)
+            numpy.testing.assert_equal(got[key], exp[key])
+        self.assertEqual(got['rate'].dtype, F32)
+        numpy.testing.assert_allclose(got['rate'], exp['rate'], rtol=1E-6)
+
+    def test_add_rates(self):
+        allsids = numpy.array([0, 3, 5, 7, 8, 11, 20, 41], numpy.uint32)
+        rates = ProbabilityMap(allsids, 4, 8).fill(0, F32)
+        rates.array[:] = self.rng.random(rates.array.shape)
+        pmap = ProbabilityMap(self.sids, 4, 3).new(
+            self.rng.random((5, 4, 3)).astype(F32))
+        gids = [1, 4, 5, 6, 7]  # more gids than columns in pmap
+        exp = rates.array.copy()
+        sidx = rates.sidx[pmap.sids]
+        for i, gid in enumerate(gids):
+            exp[sidx, :, gid] += pmap.array[:, :, i % 3]
+        rates.add_rates(pmap, gids)
+        numpy.testing.assert_allclose(rates.array, exp, rtol=1E-6)
+
+        # the same with float64 rates, not using the kernel
+        rates64 = ProbabilityMap(allsids, 4, 8).new(F64(exp))
+        rates64.add_rates(pmap.new(F64(pmap.array)), gids)
+        for i, gid in enumerate(gids):
+            exp[sidx, :, gid] += pmap.array[:, :, i % 3]
+        numpy.testing.assert_allclose(rates64.array, exp, rtol=1E-6)
@@ -26,7 +26,8 @@ def newmark_critical_accel(
     if np.isscalar(crit_accel):
         return max([0.0, crit_accel])
     else:
-        return np.array([max([0.0, ca]) for ca in crit_accel])
+        # fmax, like max, returns 0 for NaNs
+        return np.fmax(0.0, np.asarray(crit_accel))
 
 
 def newmark_displ_from_pga_M(
@@ -3,6 +3,7 @@ from typing import Callable, Union
 import os
 import tempfile
 import logging
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 import pyproj as pj
@@ -16,6 +17,21 @@ if "PROJ_DATA" not in os.environ:
     os.environ["PROJ_DATA"] = pj.datadir.get_data_dir()
 
 
+@lru_cache()
+def _get_transformer(raster_proj_wkt: str):
+    """
+    Parsing the WKT and looking up the EPSG code is slow, so the transformer
+    is built only once per projection.
+
+    :returns: a Transformer from WGS84 to the raster projection, or None if
+        the raster is already in WGS84
+    """
+    raster_proj = pj.CRS(raster_proj_wkt)
+    if raster_proj.to_epsg() == 4326:
+        return None
+    return pj.transformer.Transformer.from_crs("epsg:4326", raster_proj)
+
+
 def sample_raster_at_points(
     raster_file: str,
     lon_pts: np.ndarray,
@@ -54,26 +70,26 @@ def sample_raster_at_points(
     raster_proj_wkt = raster_ds.GetProjection()
     raster_data = raster_ds.GetRasterBand(1).ReadAsArray()
 
-    raster_proj = pj.CRS(raster_proj_wkt)
-    if raster_proj.to_epsg() != 4326:
-        trans = pj.transformer.Transformer.from_crs("epsg:4326", raster_proj)
+    trans = _get_transformer(raster_proj_wkt)
+    if trans is not None:
         lat_pts, lon_pts = trans.transform(lat_pts, lon_pts)
 
     x_rast = np.int_(np.round((lon_pts - gt[0]) / gt[1]))
     y_rast = np.int_(np.round((lat_pts - gt[3]) / gt[5]))
 
-    def sample_raster(raster, row, col):
-        if (0 <= row < raster.shape[0]) and (0 <= col < raster.shape[1]):
-            return raster[row, col]
-        else:
-            return out_of_bounds_val
-
-    interp_vals = np.array(
-        [
-            sample_raster(raster_data, y_rast[i], xr)
-            for i, xr in enumerate(x_rast)
-        ]
+    # gather all the points inside the raster with a single fancy indexing
+    inside = (
+        (y_rast >= 0)
+        & (y_rast < raster_data.shape[0])
+        & (x_rast >= 0)
+        & (x_rast < raster_data.shape[1])
+    )
+    interp_vals = np.full(
+        len(x_rast),
+        out_of_bounds_val,
+        np.result_type(raster_data, out_of_bounds_val),
     )
+    interp_vals[inside] = raster_data[y_rast[inside], x_rast[inside]]
 
     return interp_vals
 
@@ -174,13 +190,14 @@ def rolling_raster_operation(
     write: bool = False,
 ):
     if trim:
-        return NotImplementedError("Trimming not supported at this time.")
+        raise NotImplementedError("Trimming not supported at this time.")
 
     if outfile is None:
         if write:
             raise ValueError("Must specify raster outfile")
         else:
-            outfile_handler, outfile = tempfile.mkstemp(suffix=".tiff")
+            fd, outfile = tempfile.mkstemp(suffix=".tiff")
+            os.close(fd)  # gdal reopens the file by name
 
     ds = gdal.Open(in_raster)
 